@@ -11,9 +11,71 @@ import matplotlib.pyplot as plt
 import pytz
 import pvlib
 import numpy as np
+import solar_geometry
+import plot_utils
 
-def main():
-    """Run the script."""
+def etr_horizontal_mean(start, end, latitude, longitude, freq="1h"):
+    """
+    Calculate the mean extraterrestrial irradiance on the horizontal over each interval from start to end.
+    The cos(zenith) factor is integrated analytically over the hour angle of each interval, from sunrise to
+    sunset only, so partly daylit intervals get their exact average without a minutely time series.
+    Results are labelled by the start of each interval (the same as resample(freq, label="left")).
+    """
+    intervals = pd.date_range(start=start, end=end, freq=freq, tz="UTC")
+    step = pd.Timedelta(pd.tseries.frequencies.to_offset(freq))
+    midpoints = intervals + step / 2
+    #declination and equation of time change slowly so the values at the middle of each interval are used, with the day of year as a fraction so they are taken at that time of day and not at midnight.
+    doy = midpoints.dayofyear + (midpoints - midpoints.normalize()).total_seconds().to_numpy() / 86400
+    declination = pvlib.solarposition.declination_spencer71(doy)
+    eot = pvlib.solarposition.equation_of_time_spencer71(doy)
+    #hour angle (radians) at the start and end of each interval, with the start wrapped into [-pi, pi).
+    h_start = np.radians(pvlib.solarposition.hour_angle(intervals, longitude, eot))
+    h_start = (h_start + np.pi) % (2 * np.pi) - np.pi
+    h_end = h_start + step.total_seconds() / 86400 * 2 * np.pi
+    #sunset hour angle (0 for polar night, pi for midnight sun).
+    lat = np.radians(latitude)
+    sunset = np.arccos(np.clip(-np.tan(lat) * np.tan(declination), -1, 1))
+    #cos(zenith) = sin(lat)sin(dec) + cos(lat)cos(dec)cos(h), integrated between the clipped limits. The interval
+    #can run past midnight (h = pi) so the part shifted back by a full day is integrated too.
+    integral = 0
+    for shift in (0, 2 * np.pi):
+        a = np.clip(h_start - shift, -sunset, sunset)
+        b = np.clip(h_end - shift, -sunset, sunset)
+        integral = integral + np.sin(lat) * np.sin(declination) * (b - a) + np.cos(lat) * np.cos(declination) * (np.sin(b) - np.sin(a))
+    mean_cos_zenith = integral / (h_end - h_start)
+    etr = pvlib.irradiance.get_extra_radiation(midpoints)
+    return pd.Series(np.asarray(etr) * mean_cos_zenith, index=intervals)
+
+def plot_etr_global(etr_h_hor, global_h):
+    """Plot the horizontal etr and the measured global irradiance and return the figure."""
+    #long time series are thinned out to the highest and lowest values in each pixel column before plotting (see plot_utils.py), which looks the same but is much quicker.
+    fig, ax = plt.subplots()
+    plot_utils.plot_decimated(etr_h_hor, ax)
+    plot_utils.plot_decimated(global_h, ax)
+    return fig
+
+def plot_kt(kt):
+    """Plot the kt time series and return the figure."""
+    fig, ax = plt.subplots()
+    plot_utils.plot_decimated(kt, ax)
+    return fig
+
+def plot_kt_histogram(kt, bandwidth=None):
+    """Plot the kt histogram with a kernel density estimate over it and return the figure."""
+    fig, ax = plt.subplots()
+    #the histogram is normalised to a probability density so the smooth kernel density estimate can be drawn over it.
+    ax.hist(kt, bins=100, density=True)
+    kt_grid, kt_density = plot_utils.binned_kde(kt, bandwidth=bandwidth, range=(0, 1.3))
+    ax.plot(kt_grid, kt_density)
+    return fig
+
+def main(headless=False, output_dir="figures"):
+    """
+    Run the script.
+    With headless=True the figures are saved to output_dir as png files instead of being shown, so no display is needed.
+    """
+    if headless:
+        plt.switch_backend("Agg")
     ##### INPUTS #####  make sure these are consistent with the Global horizontal observation data that you are loading!
     start = datetime(2014, 1, 1, 0, 0, tzinfo=pytz.UTC)
     end = datetime(2014, 12, 31, 0, 0, tzinfo=pytz.UTC)
@@ -23,37 +85,53 @@ def main():
     #Air mass depends on altitude!
     altitude = 100
     tz = "UTC"
+    #solar position engine: "spa" (reference), "numba", "ephemeris" or "interp" - see benchmark_solar_position.py for speed vs accuracy
+    engine = "spa"
     filetoread = "sheffield2014global.csv"
     df = pd.read_csv(filetoread, index_col=0, parse_dates=True)
     df = df.tz_localize('UTC')
     filename = "pv_test_data.csv"
+    #analytic = True averages the horizontal etr over each hour analytically (see etr_horizontal_mean), False works it out from a minutely time series.
+    analytic = True
     ##################
         
-    times = pd.date_range(start = start, end = end, tz = tz, freq = "min")
-    loc = pvlib.location.Location(latitude=latitude, longitude=longitude, altitude=altitude)
-    
-    #solpos calculates the position of the sun in the sky. It returns a set of angles that you should investigate in detail.
-    solpos = loc.get_solarposition(times, temperature=12)
-    #etr is the extraterrestrial solar radiation - but it is not corrected to the horizontal plane at a particular latitude and longitude. to do this correction we need to know the zenith angle (which is contained within the solpos method).
-    etr = pvlib.irradiance.get_extra_radiation(times)
-    zen = solpos["apparent_zenith"]
-    etr_hor = np.cos(np.radians(zen)) * etr
-    #etr in the horizontal plane is calculated for all times at minutely resolution. when the sun is behind the earth the value is negative (which makes no sense) so we set it to zero.
-    etr_hor[etr_hor < 0] = 0
-    #we can then resample the minutely time series to hourly by taking the hourly average power.
-    etr_h_hor = etr_hor.resample("1h", label="left").mean()
+    if analytic:
+        #the hourly average of the etr on the horizontal plane, calculated directly from the sun's path across the sky during each hour.
+        etr_h_hor = etr_horizontal_mean(start, end, latitude, longitude, freq="1h")
+    else:
+        times = pd.date_range(start = start, end = end, tz = tz, freq = "min")
+        
+        #solpos calculates the position of the sun in the sky. It returns a set of angles that you should investigate in detail.
+        #the angles only depend on the site and the times, so they are saved to disk the first time and re-used on later runs (see solar_geometry.py).
+        solpos = solar_geometry.get_solar_geometry(times, latitude, longitude, altitude=altitude, temperature=12, freq="min", engine=engine)
+        #etr is the extraterrestrial solar radiation - but it is not corrected to the horizontal plane at a particular latitude and longitude. to do this correction we need to know the zenith angle (which is contained within the solpos method).
+        etr = solpos["eai_global"]
+        zen = solpos["apparent_zenith"]
+        etr_hor = np.cos(np.radians(zen)) * etr
+        #etr in the horizontal plane is calculated for all times at minutely resolution. when the sun is behind the earth the value is negative (which makes no sense) so we set it to zero.
+        etr_hor[etr_hor < 0] = 0
+        #we can then resample the minutely time series to hourly by taking the hourly average power.
+        etr_h_hor = etr_hor.resample("1h", label="left").mean()
         
-    ax = etr_h_hor.plot()
     #correct by x1000 to get the same units of both the etr and Global data.
     df.global_h = df.global_h * 1000
-    df.global_h.plot(ax=ax)
-    plt.show()
     kt = df.global_h / etr_h_hor
     #very high values of KT (due to bad measurements) are filtered out.
     kt[kt > 1.3] = np.nan
-    kt.plot()
+    #kt_bandwidth sets how smooth the kernel density estimate over the kt histogram is (None picks one from the data).
+    kt_bandwidth = None
+    
+    if headless:
+        #each figure is drawn in its own process and saved as a png (see plot_utils.render_figures).
+        jobs = [("kt_etr_global.png", plot_etr_global, (etr_h_hor, df.global_h)),
+                ("kt_timeseries.png", plot_kt, (kt,)),
+                ("kt_histogram.png", plot_kt_histogram, (kt, kt_bandwidth))]
+        return plot_utils.render_figures(jobs, output_dir)
+    plot_etr_global(etr_h_hor, df.global_h)
+    plt.show()
+    plot_kt(kt)
     plt.show()
-    plt.hist(kt, bins=100)
+    plot_kt_histogram(kt, kt_bandwidth)
     plt.show()
 
 if __name__ == "__main__":
@@ -7,49 +7,143 @@ Modified A Buckley
 2020-07-02
 """
 
+import os
+import hashlib
 from datetime import datetime
 import pandas as pd
 import numpy as np
 import pvlib
 import matplotlib.pyplot as plt
-from scipy.stats import gaussian_kde
+import solar_geometry
+import plot_utils
+import cache_utils
 
-def load_testbed_data(filename):
-    """Load pyranometer data from a CSV file."""
-    # Use the `with open(...) as ...` syntax (context manager) to ensure files are closed on error
-    with open(filename) as fid:
-        # Load the CSV file, ensuring the dateandtime column is parsed as a timestamp
-        data = pd.read_csv(fid, parse_dates=["dateandtime"])
+CACHE_DIR = "cache"
+
+def _cache_path(filename, cache_dir):
+    """
+    Return the cache file for a CSV, named "<stem>-<path hash>.<size>-<mtime>.npz". The hash of the absolute
+    path keeps files with the same name in different directories apart, the size and modification time
+    tell when the CSV has changed.
+    """
+    stat = os.stat(filename)
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    path_hash = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{stem}-{path_hash}.{stat.st_size}-{stat.st_mtime_ns}.npz")
+
+def _load_frame(filename):
+    """Rebuild a UTC-indexed dataframe from a .npz file of columns written by _save_frame."""
+    with np.load(filename, allow_pickle=False) as npz:
+        columns = [str(c) for c in npz["columns"]]
+        index = pd.DatetimeIndex(npz["timestamp"], tz="UTC", name="timestamp")
+        return pd.DataFrame({c: npz[f"col_{i}"] for i, c in enumerate(columns)}, index=index)
+
+def _save_frame(data, filename):
+    """Store each column of a UTC-indexed dataframe as a separate uncompressed array."""
+    arrays = {f"col_{i}": data[c].to_numpy() for i, c in enumerate(data.columns)}
+    cache_utils.save_npz(filename, timestamp=data.index.tz_convert(None).to_numpy(dtype="datetime64[ns]"),
+                         columns=np.array(data.columns, dtype=str), **arrays)
+
+def _write_cache(data, cache_file):
+    """Save the dataframe as the cache of a CSV, replacing any older cache of the same file."""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # Remove stale caches of the same file (written before it last changed). The key is everything before the
+    # ".<size>-<mtime>.npz" suffix, so stems containing dots are compared whole
+    key = os.path.basename(cache_file).rsplit(".", 2)[0]
+    for old in os.listdir(os.path.dirname(cache_file)):
+        if old.endswith(".npz") and old.rsplit(".", 2)[0] == key:
+            os.remove(os.path.join(os.path.dirname(cache_file), old))
+    _save_frame(data, cache_file)
+
+def _tidy_testbed_data(data):
+    """Rename the testbed columns and index the data by UTC timestamp."""
     # Use the col_mapper dictionary to rename cols
     col_mapper = {"dateandtime": "timestamp", "GHI": "ghi", "DHI": "dhi"}
     data.rename(columns=col_mapper, inplace=True)
     # Set the timestamp as the index of the dataframe
     data.set_index("timestamp", inplace=True)
     # Tell pandas our timestamps are UTC
-    data = data.tz_localize(tz="UTC")
+    return data.tz_localize(tz="UTC")
+
+def load_testbed_data(filename, cache_dir=CACHE_DIR):
+    """
+    Load pyranometer data from a CSV file.
+    The parsed data is cached in `cache_dir` as binary columns and re-used until the CSV changes
+    (size or modification time). Pass cache_dir=None to always parse the CSV.
+    """
+    cache_file = _cache_path(filename, cache_dir) if cache_dir is not None else None
+    if cache_file is not None and os.path.exists(cache_file):
+        return _load_frame(cache_file)
+    # Use the `with open(...) as ...` syntax (context manager) to ensure files are closed on error
+    with open(filename) as fid:
+        # Load the CSV file, ensuring the dateandtime column is parsed as a timestamp
+        data = pd.read_csv(fid, parse_dates=["dateandtime"])
+    data = _tidy_testbed_data(data)
+    if cache_file is not None:
+        _write_cache(data, cache_file)
     return data
 
-def simulate_eai(start, end, lat, lon, freq="1min"):
-    """Simulate EAI for a given time range, location and frequency."""
-    # Create a DatetimeIndex of minutely timestamps
-    times = pd.date_range(start=start, end=end, freq=freq, tz="UTC")
-    # Create a Location object
-    loc = pvlib.location.Location(lat, lon, tz="UTC", altitude=130, name="Hicks Bulding Lower Roof")
-    # Compute the solar position for the times
-    solpos = loc.get_solarposition(times)
-    # Simulate EAI for the times (not corrected for location)
-    eai_global = pvlib.irradiance.get_extra_radiation(times)
+def iter_testbed_data(filename, chunk_days=7, chunksize=50000):
+    """
+    Load pyranometer data from a CSV file as a sequence of day-aligned chunks.
+    Each chunk covers at most `chunk_days` whole (UTC) days, so memory use depends on the chunk size
+    and not on the length of the file. The CSV is read `chunksize` rows at a time and must be in
+    time order.
+    """
+    pending = None
+    with open(filename) as fid:
+        for part in pd.read_csv(fid, parse_dates=["dateandtime"], chunksize=chunksize):
+            part = _tidy_testbed_data(part)
+            pending = part if pending is None else pd.concat([pending, part])
+            # Hand on every complete block of days, keeping back the last day as it may not be complete yet
+            last_day = pending.index[-1].normalize()
+            boundary = pending.index[0].normalize() + pd.Timedelta(days=chunk_days)
+            while boundary <= last_day:
+                cut = pending.index.searchsorted(boundary)
+                yield pending.iloc[:cut]
+                pending = pending.iloc[cut:]
+                boundary = pending.index[0].normalize() + pd.Timedelta(days=chunk_days)
+    if pending is not None and len(pending) > 0:
+        yield pending
+
+def simulate_eai(start, end, lat, lon, freq="1min", times=None, engine="spa", geometry_cache=solar_geometry.CACHE_DIR):
+    """
+    Simulate EAI for a given time range, location and frequency.
+    If `times` (a DatetimeIndex) is given the EAI and solar position are calculated at exactly those
+    timestamps instead, and `start`, `end` and `freq` are ignored.
+    The solar position is calculated with `engine` (see solar_geometry.ENGINES) and read from (and saved to)
+    the cache in `geometry_cache`, use None to always recalculate.
+    """
+    if times is None:
+        # Create a DatetimeIndex of minutely timestamps
+        times = pd.date_range(start=start, end=end, freq=freq, tz="UTC")
+    else:
+        # Measured timestamps are looked up on the minutely grid
+        freq = "1min"
+    # Compute the solar position for the times at the Hicks Building Lower Roof (altitude 130 m), and
+    # simulate EAI for the times (not corrected for location)
+    geometry = solar_geometry.get_solar_geometry(times, lat, lon, altitude=130, freq=freq, engine=engine,
+                                                 cache_dir=geometry_cache)
+    solpos = geometry[["zenith", "apparent_zenith", "azimuth"]]
+    eai_global = geometry["eai_global"]
     # Correct for location
     eai = eai_global * np.cos(np.radians(solpos["apparent_zenith"]))
     eai[eai < 0] = 0
-    # Convert EAI to a Dataframe with named column (helpful later)
-    eai = pd.DataFrame(eai, columns=["eai"])
-    eai_global = pd.DataFrame(eai_global, columns=["eai_global"])
-    eai = eai.merge(eai_global, left_index=True, right_index=True)
+    # Convert EAI to a Dataframe with named columns (helpful later), both series already share the same index
+    eai = pd.DataFrame({"eai": eai, "eai_global": eai_global})
     return eai, solpos
 
-def produce_plots2(erbs, irr, kt, inplane):
-    """Produce some nice plots and save them to disk."""
+def _density_mode(density, n_points):
+    """Resolve produce_plots2's density argument into False, "hist2d", "hexbin" or "kde"."""
+    if density is None:
+        density = n_points > plot_utils.DENSITY_THRESHOLD
+    if density is True:
+        return "hist2d"
+    return density
+
+def plot_kd_scatter(erbs, irr, density=None):
+    """Plot the Erbs diffuse fraction against the measured one and return the figure."""
+    density = _density_mode(density, len(irr))
     # Create a new figure
     fig = plt.figure()
     ax = fig.add_subplot()
@@ -58,24 +152,39 @@ def produce_plots2(erbs, irr, kt, inplane):
     ## Plot kd_erbs vs kd
     actual_kd = irr["dhi"] / irr["ghi"]
     modelled_kd = erbs["dhi"] / irr["ghi"]
-    plt.scatter(actual_kd, modelled_kd, edgecolor='', alpha=0.3)
+    if density == "kde":
+        fig.colorbar(plot_utils.kde_scatter(ax, actual_kd, modelled_kd, range=((0, 1.2), (0, 1.2))), ax=ax, label="Density")
+    elif density:
+        fig.colorbar(plot_utils.density_plot(ax, actual_kd, modelled_kd, mode=density, range=((0, 1.2), (0, 1.2))), ax=ax, label="Count")
+    else:
+        plt.scatter(actual_kd, modelled_kd, edgecolor='none', alpha=0.3)
     # Label the axes
     ax.set_xlabel('Actual kd')
     ax.set_ylabel('Modelled kd')
+    return fig
+
+def plot_gti_ghi_timeseries(irr, inplane):
+    """Plot GTI and GHI against time and return the figure."""
     ## Plot GTI and GHI
     # Create a new figure
     fig = plt.figure()
+    ax = fig.add_subplot()
     # Add title
     fig.suptitle("GTI vs GHI")
-    # Plot GHI
-    ax = irr["ghi"].plot(label="GHI")
+    # Plot GHI, only keeping the highest and lowest values in each pixel column so long series plot quickly
+    plot_utils.plot_decimated(irr["ghi"], ax, label="GHI")
     # Plot GTI
-    inplane["poa_global"].plot(ax=ax, label="GTI")
+    plot_utils.plot_decimated(inplane["poa_global"], ax, label="GTI")
     # Label the axes
     ax.set_xlabel('Timestamp')
     ax.set_ylabel('Irradiance (W/m^2)')
     # Show legend entries
     ax.legend()
+    return fig
+
+def plot_gti_ghi_scatter(irr, inplane, density=None):
+    """Plot GTI against GHI and return the figure."""
+    density = _density_mode(density, len(irr))
     ## Plot GTI vs GHI
     # Create a new figure
     fig = plt.figure()
@@ -83,21 +192,43 @@ def produce_plots2(erbs, irr, kt, inplane):
     # Add title
     fig.suptitle("GTI vs GHI")
     # Plot
-    plt.scatter(irr["ghi"], inplane["poa_global"], edgecolor='', alpha=0.3)
+    if density == "kde":
+        fig.colorbar(plot_utils.kde_scatter(ax, irr["ghi"], inplane["poa_global"]), ax=ax, label="Density")
+    elif density:
+        fig.colorbar(plot_utils.density_plot(ax, irr["ghi"], inplane["poa_global"], mode=density), ax=ax, label="Count")
+    else:
+        plt.scatter(irr["ghi"], inplane["poa_global"], edgecolor='none', alpha=0.3)
     ax.set_xlabel('GHI (W/m2)')
     ax.set_ylabel('GTI (W/m2)')
+    return fig
 
-def main(testbed_data_file, lat, lon, orientation, tilt):
-    """Run from command line."""
-    # Load the pyranometer data from CSV
-    irr = load_testbed_data(testbed_data_file)
-    # Determine the start/end date based on the pyran data just loaded
-    start = irr.index[0]
-    end = irr.index[-1]
-    # Simulate the minutely EAI for the same period
-    eai, solpos = simulate_eai(start, end, lat, lon)
-    # Merge the irr, eai and solpos df's so only indices in both are kept
-    irr_ = irr.merge(solpos, left_index=True, right_index=True).merge(eai, left_index=True, right_index=True)
+def produce_plots2(erbs, irr, kt, inplane, density=None):
+    """
+    Produce some nice plots.
+    With density=True (or "hist2d"/"hexbin") the scatter plots are drawn as 2-D histograms (see
+    plot_utils.density_plot), which is much faster for large data sets. density="kde" keeps the points but colours
+    them by a binned kernel density estimate (see plot_utils.kde_scatter). By default histograms are used when there
+    are more than plot_utils.DENSITY_THRESHOLD points.
+    """
+    plot_kd_scatter(erbs, irr, density=density)
+    plot_gti_ghi_timeseries(irr, inplane)
+    plot_gti_ghi_scatter(irr, inplane, density=density)
+
+def plot_jobs(erbs, irr, inplane, name, density=None):
+    """
+    List the figures of produce_plots2 as (filename, plot function, arguments) for plot_utils.render_figures.
+    Only the columns each plot needs are passed, to keep the data sent to worker processes small.
+    """
+    irr = irr[["ghi", "dhi"]]
+    return [(f"{name}_kd_scatter.png", plot_kd_scatter, (erbs[["dhi"]], irr, density)),
+            (f"{name}_gti_ghi_timeseries.png", plot_gti_ghi_timeseries, (irr, inplane[["poa_global"]])),
+            (f"{name}_gti_ghi_scatter.png", plot_gti_ghi_scatter, (irr, inplane[["poa_global"]], density))]
+
+def process_irradiance(irr, lat, lon, orientation, tilt):
+    """Calculate kt, the Erbs decomposition and the in-plane irradiance for a block of pyranometer data."""
+    # Simulate the EAI at the pyran timestamps only, so the results line up with the data without merging
+    eai, solpos = simulate_eai(None, None, lat, lon, times=irr.index)
+    irr_ = pd.concat([irr, solpos, eai], axis=1)
     # Calculate kt and then set an INF kt values (caused by dividing by 0) to NaN
     kt = irr_["ghi"] / irr_["eai"]
     kt[kt == np.inf] = np.nan
@@ -107,14 +238,399 @@ def main(testbed_data_file, lat, lon, orientation, tilt):
     erbs = pvlib.irradiance.erbs(irr_["ghi"], irr_["zenith"], irr_.index)
     # Transpose to the inclined plane
     inplane = pvlib.irradiance.get_total_irradiance(tilt, orientation, irr_["zenith"], irr_["azimuth"], erbs["dni"], irr_["ghi"], erbs["dhi"], irr_["eai_global"], surface_type="urban",   model="haydavies")
+    return irr_, kt, erbs, inplane
+
+# Resolutions of the aggregation pyramid, from finest to coarsest. Weeks start on Monday
+PYRAMID_LEVELS = ("hourly", "daily", "weekly", "monthly", "annual")
+
+def pipeline_frame(irr_, kt, erbs, inplane):
+    """Collect the outputs of process_irradiance into a single dataframe (Erbs columns are prefixed "erbs_")."""
+    return pd.concat([irr_[["ghi", "dhi", "eai", "eai_global"]], kt.rename("kt"), erbs.add_prefix("erbs_"), inplane],
+                     axis=1)
+
+def split_pipeline_frame(frame):
+    """Split a frame from pipeline_frame (or one level of the pyramid) back into erbs, irr, kt and inplane."""
+    erbs = frame[["erbs_dni", "erbs_dhi", "erbs_kt"]].rename(columns=lambda c: c[len("erbs_"):])
+    inplane = frame[[c for c in frame.columns if c.startswith("poa_")]]
+    return erbs, frame[["ghi", "dhi", "eai", "eai_global"]], frame["kt"], inplane
+
+def _bin_starts(starts, level):
+    """Return the start of the `level` bin that each (hourly) bin start falls in."""
+    naive = starts.tz_convert(None)
+    if level == "daily":
+        naive = naive.floor("D")
+    elif level == "weekly":
+        naive = naive.floor("D") - pd.to_timedelta(naive.dayofweek, unit="D")
+    elif level == "monthly":
+        naive = naive.to_period("M").to_timestamp()
+    elif level == "annual":
+        naive = naive.to_period("Y").to_timestamp()
+    elif level != "hourly":
+        raise ValueError(f"Unknown pyramid level {level!r}, choose from {PYRAMID_LEVELS}")
+    return naive.tz_localize("UTC")
+
+def aggregation_pyramid(frame, levels=PYRAMID_LEVELS):
+    """
+    Calculate the sums and counts of valid (non-NaN) values of every column at each resolution in `levels`.
+    The minute data are reduced to hourly bins once, with np.add.reduceat on the bin edges (the data must be in
+    time order), and every coarser level is reduced from the hourly sums and counts.
+    Returns a dict of {level: {"sum": dataframe, "count": dataframe}}, see pyramid_means.
+    """
+    values = frame.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    # Edges of the hourly bins are where the hour changes from one row to the next
+    hours = frame.index.asi8 // pd.Timedelta("1h").value
+    edges = np.flatnonzero(np.r_[True, hours[1:] != hours[:-1]])
+    sums = np.add.reduceat(np.where(valid, values, 0), edges, axis=0)
+    counts = np.add.reduceat(valid, edges, axis=0)
+    starts = pd.DatetimeIndex(hours[edges] * pd.Timedelta("1h").value, tz="UTC", name="timestamp")
+    return _reduce_hourly(sums, counts, starts, frame.columns, levels)
+
+def _reduce_hourly(sums, counts, starts, columns, levels):
+    """Reduce hourly sums and counts (in time order, labelled by `starts`) to each level of the pyramid."""
+    pyramid = {}
+    for level in PYRAMID_LEVELS:
+        level_starts = _bin_starts(starts, level)
+        level_edges = np.flatnonzero(np.r_[True, level_starts[1:] != level_starts[:-1]])
+        level_sums = np.add.reduceat(sums, level_edges, axis=0)
+        level_counts = np.add.reduceat(counts, level_edges, axis=0)
+        if level in levels:
+            index = level_starts[level_edges]
+            pyramid[level] = {"sum": pd.DataFrame(level_sums, index=index, columns=columns),
+                              "count": pd.DataFrame(level_counts, index=index, columns=columns)}
+    return pyramid
+
+def combine_pyramids(pyramids, levels=PYRAMID_LEVELS):
+    """
+    Combine the pyramids of consecutive chunks of data (in time order) into the pyramid of all of them.
+    Only the hourly level of each chunk is needed; every level is reduced again from the joined hourly sums
+    and counts, so an hour split between two chunks is still counted once.
+    """
+    sums = pd.concat([pyramid["hourly"]["sum"] for pyramid in pyramids])
+    counts = pd.concat([pyramid["hourly"]["count"] for pyramid in pyramids])
+    return _reduce_hourly(sums.to_numpy(), counts.to_numpy(), sums.index, sums.columns, levels)
+
+def pyramid_means(pyramid, level):
+    """Return the mean of every column at one level of the pyramid (NaN where there were no valid values)."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pyramid[level]["sum"] / pyramid[level]["count"].where(pyramid[level]["count"] > 0)
+
+def pyramid_dir(testbed_data_file, lat, lon, orientation, tilt, cache_dir=CACHE_DIR):
+    """
+    Return the directory the pyramid of one analysis is saved in. Most columns depend on the site and the plane
+    as well as the data, so the name has the file stem, orientation and tilt, and a hash of the absolute file path
+    and the site (so files with the same name in different directories are kept apart too).
+    """
+    stem = os.path.splitext(os.path.basename(testbed_data_file))[0]
+    key = hashlib.sha1(f"{os.path.abspath(testbed_data_file)}|{lat:.5f}|{lon:.5f}".encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{stem}_{orientation:g}_{tilt:g}-{key}_pyramid")
+
+def save_pyramid(pyramid, directory):
+    """Save an aggregation pyramid as one .npz file of sums and one of counts per level."""
+    os.makedirs(directory, exist_ok=True)
+    for level, tables in pyramid.items():
+        for kind, table in tables.items():
+            _save_frame(table, os.path.join(directory, f"{level}_{kind}.npz"))
+
+def load_pyramid(directory):
+    """Load an aggregation pyramid saved by save_pyramid."""
+    pyramid = {}
+    for level in PYRAMID_LEVELS:
+        if os.path.exists(os.path.join(directory, f"{level}_sum.npz")):
+            pyramid[level] = {kind: _load_frame(os.path.join(directory, f"{level}_{kind}.npz"))
+                              for kind in ("sum", "count")}
+    return pyramid
+
+# Averaging intervals compared by integration_error_study
+STUDY_INTERVALS = ("2min", "5min", "10min", "15min", "30min", "60min", "1D")
+
+def integration_error_study(irr_, inplane, tilt, orientation, intervals=STUDY_INTERVALS):
+    """
+    Measure the error from calculating the in-plane irradiance from time-averaged inputs.
+    For each interval the GHI, EAI and sun position (as the mean of the sun's unit vector) are averaged, run
+    through Erbs and Hay-Davies, and compared with the average of the minutely in-plane irradiance (`inplane`
+    from process_irradiance). All the averages come from prefix sums, so each extra interval costs one pass to
+    find its bin edges plus the models on the (much shorter) averaged series.
+    Returns the bias and RMSE (W/m^2 and % of the mean in-plane irradiance) for each interval.
+    """
+    zenith = np.radians(irr_["zenith"].to_numpy())
+    azimuth = np.radians(irr_["azimuth"].to_numpy())
+    columns = {"ghi": irr_["ghi"].to_numpy(), "eai_global": irr_["eai_global"].to_numpy(),
+               "sun_x": np.sin(zenith) * np.sin(azimuth), "sun_y": np.sin(zenith) * np.cos(azimuth),
+               "sun_z": np.cos(zenith), "poa_global": inplane["poa_global"].to_numpy()}
+    # Prefix sums (with a leading zero) of each column and of its count of valid values
+    prefix = {}
+    for name, values in columns.items():
+        valid = ~np.isnan(values)
+        prefix[name] = (np.r_[0, np.cumsum(np.where(valid, values, 0))], np.r_[0, np.cumsum(valid)])
+    rows = []
+    for interval in intervals:
+        step = pd.Timedelta(interval).value
+        codes = irr_.index.asi8 // step
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:], len(codes)]
+        means = {}
+        for name, (sums, counts) in prefix.items():
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means[name] = (sums[ends] - sums[starts]) / (counts[ends] - counts[starts])
+        times = pd.DatetimeIndex(codes[starts] * step + step // 2, tz="UTC")
+        mean_zenith = pd.Series(np.degrees(np.arctan2(np.hypot(means["sun_x"], means["sun_y"]), means["sun_z"])), index=times)
+        mean_azimuth = pd.Series(np.degrees(np.arctan2(means["sun_x"], means["sun_y"])) % 360, index=times)
+        ghi = pd.Series(means["ghi"], index=times)
+        erbs = pvlib.irradiance.erbs(ghi, mean_zenith, times)
+        poa = pvlib.irradiance.get_total_irradiance(tilt, orientation, mean_zenith, mean_azimuth, erbs["dni"], ghi, erbs["dhi"],
+                                                    pd.Series(means["eai_global"], index=times), surface_type="urban",
+                                                    model="haydavies")["poa_global"].to_numpy()
+        error = poa - means["poa_global"]
+        error = error[~np.isnan(error)]
+        mean_poa = np.nanmean(means["poa_global"])
+        bias = error.mean()
+        rmse = np.sqrt((error ** 2).mean())
+        rows.append({"interval": interval, "bins": len(error), "mean_poa": mean_poa, "bias": bias, "rmse": rmse,
+                     "bias_%": 100 * bias / mean_poa, "rmse_%": 100 * rmse / mean_poa})
+    return pd.DataFrame(rows).set_index("interval")
+
+def main_integration_study(testbed_data_file, lat, lon, orientation, tilt):
+    """Print and plot the in-plane irradiance error against averaging interval for the testbed data."""
+    irr = load_testbed_data(testbed_data_file)
+    irr_, kt, erbs, inplane = process_irradiance(irr, lat, lon, orientation, tilt)
+    study = integration_error_study(irr_, inplane, tilt, orientation)
+    print(study.to_string(float_format="{:.3f}".format))
+    fig = plt.figure()
+    ax = fig.add_subplot()
+    fig.suptitle("GTI error from averaged inputs")
+    minutes = [pd.Timedelta(interval).total_seconds() / 60 for interval in study.index]
+    ax.plot(minutes, study["bias"], "o-", label="Bias")
+    ax.plot(minutes, study["rmse"], "s-", label="RMSE")
+    ax.set_xscale("log")
+    ax.set_xlabel("Averaging interval (minutes)")
+    ax.set_ylabel("Error (W/m^2)")
+    ax.legend()
+    plt.show()
+    return study
+
+def poa_sweep(irr_, erbs, tilts, orientations, albedo=pvlib.albedo.SURFACE_ALBEDOS["urban"], chunk_size=64):
+    """
+    Calculate the in-plane irradiation (Hay-Davies, as in process_irradiance) for every tilt/orientation pair.
+    irr_ and erbs are the outputs of process_irradiance, so the solar position and decomposition are shared by
+    every orientation. The transposition is broadcast over an (orientation x time) array, `chunk_size`
+    orientations at a time to bound memory.
+    Returns the monthly and annual irradiation in kWh/m^2 (mean irradiance x hours, so gaps in the data are
+    not counted as zero) for each (tilt, orientation), and the (tilt, orientation) with the highest annual total.
+    """
+    tilt_grid, orientation_grid = np.meshgrid(np.asarray(tilts, dtype=float), np.asarray(orientations, dtype=float), indexing="ij")
+    tilt_grid = tilt_grid.ravel()[:, np.newaxis]
+    orientation_grid = orientation_grid.ravel()[:, np.newaxis]
+    # Everything that does not depend on the orientation is worked out once
+    zenith = np.radians(irr_["zenith"].to_numpy())
+    cos_zenith = np.cos(zenith)
+    sin_zenith = np.sin(zenith)
+    azimuth = np.radians(irr_["azimuth"].to_numpy())
+    dni = erbs["dni"].to_numpy()
+    dhi = erbs["dhi"].to_numpy()
+    ghi = irr_["ghi"].to_numpy()
+    # Hay-Davies anisotropy index, and the circumsolar irradiance per unit of beam projection
+    anisotropy = dni / irr_["eai_global"].to_numpy()
+    circumsolar = dhi * anisotropy / np.maximum(cos_zenith, 0.01745)
+    isotropic = dhi * (1 - anisotropy)
+    # Rows are split into calendar months (the data are in time order) for the monthly means
+    months = irr_.index.tz_convert(None).to_period("M")
+    month_starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+    month_hours = np.array([period.days_in_month * 24 for period in months[month_starts]])
+    monthly = np.empty((len(tilt_grid), len(month_starts)))
+    for first in range(0, len(tilt_grid), chunk_size):
+        tilt = np.radians(tilt_grid[first:first + chunk_size])
+        orientation = np.radians(orientation_grid[first:first + chunk_size])
+        projection = np.clip(np.cos(tilt) * cos_zenith + np.sin(tilt) * sin_zenith * np.cos(azimuth - orientation), -1, 1)
+        poa = np.maximum(dni * projection, 0)
+        poa += np.maximum(circumsolar * np.maximum(projection, 0), 0)
+        poa += np.maximum(isotropic * 0.5 * (1 + np.cos(tilt)), 0)
+        poa += ghi * albedo * 0.5 * (1 - np.cos(tilt))
+        # Mean irradiance in each month, ignoring missing values
+        valid = ~np.isnan(poa)
+        sums = np.add.reduceat(np.where(valid, poa, 0), month_starts, axis=1)
+        counts = np.add.reduceat(valid, month_starts, axis=1)
+        with np.errstate(invalid="ignore"):
+            monthly[first:first + chunk_size] = sums / counts * month_hours / 1000
+    index = pd.MultiIndex.from_arrays([tilt_grid.ravel(), orientation_grid.ravel()], names=["tilt", "orientation"])
+    monthly = pd.DataFrame(monthly, index=index, columns=months[month_starts])
+    annual = monthly.sum(axis=1, min_count=1).rename("annual")
+    return monthly, annual, annual.idxmax()
+
+def main_sweep(testbed_data_file, lat, lon, tilts, orientations):
+    """Find the tilt/orientation with the highest annual in-plane irradiation from the testbed data."""
+    irr = load_testbed_data(testbed_data_file)
+    # The orientation used here does not matter, only the shared solar position and decomposition are kept
+    irr_, kt, erbs, inplane = process_irradiance(irr, lat, lon, 180, 0)
+    monthly, annual, (tilt, orientation) = poa_sweep(irr_, erbs, tilts, orientations)
+    print(f"Optimum tilt {tilt:g} deg, orientation {orientation:g} deg: {annual.max():.1f} kWh/m^2")
+    # Plot the annual irradiation as a map over tilt and orientation
+    fig = plt.figure()
+    ax = fig.add_subplot()
+    fig.suptitle("Annual in-plane irradiation (kWh/m^2)")
+    mesh = ax.pcolormesh(orientations, tilts, annual.unstack("orientation").to_numpy(), shading="nearest")
+    fig.colorbar(mesh, ax=ax)
+    ax.plot(orientation, tilt, "k+")
+    ax.set_xlabel("Orientation (deg)")
+    ax.set_ylabel("Tilt (deg)")
+    plt.show()
+    return monthly, annual
+
+# Decomposition (GHI -> DNI/DHI) and transposition (sky diffuse on the inclined plane) models that compare_models can run
+DECOMPOSITION_MODELS = ("erbs", "disc", "dirint", "boland")
+TRANSPOSITION_MODELS = ("isotropic", "klucher", "reindl", "haydavies", "perez")
+# Only compare rows with at least this much GHI (W/m^2) and the sun this far above the horizon (zenith, deg)
+COMPARE_MIN_GHI = 20
+COMPARE_MAX_ZENITH = 85
+
+def _decompose(model, irr_, pressure):
+    """Split GHI into DNI and DHI with one of DECOMPOSITION_MODELS."""
+    ghi, zenith, times = irr_["ghi"], irr_["zenith"], irr_.index
+    if model == "erbs":
+        dni = pvlib.irradiance.erbs(ghi, zenith, times)["dni"]
+    elif model == "disc":
+        dni = pvlib.irradiance.disc(ghi, zenith, times, pressure=pressure)["dni"]
+    elif model == "dirint":
+        dni = pvlib.irradiance.dirint(ghi, zenith, times, pressure=pressure)
+    elif model == "boland":
+        dni = pvlib.irradiance.boland(ghi, zenith, times)["dni"]
+    else:
+        raise ValueError(f"Unknown decomposition model {model!r}, choose from {DECOMPOSITION_MODELS}")
+    # Close the balance so DHI + DNI cos(zenith) = GHI for every model
+    dni = dni.fillna(0)
+    return dni, ghi - dni * irr_["cos_zenith"]
+
+def _sky_diffuse(model, tilt, orientation, irr_, dni, dhi):
+    """Transpose DHI to the inclined plane with one of TRANSPOSITION_MODELS."""
+    zenith, azimuth, ghi, dni_extra = irr_["zenith"], irr_["azimuth"], irr_["ghi"], irr_["eai_global"]
+    if model == "isotropic":
+        return pvlib.irradiance.isotropic(tilt, dhi)
+    elif model == "klucher":
+        return pvlib.irradiance.klucher(tilt, orientation, dhi, ghi, zenith, azimuth)
+    elif model == "reindl":
+        return pvlib.irradiance.reindl(tilt, orientation, dhi, dni, ghi, dni_extra, zenith, azimuth)
+    elif model == "haydavies":
+        return pvlib.irradiance.haydavies(tilt, orientation, dhi, dni, dni_extra, projection_ratio=irr_["projection_ratio"])
+    elif model == "perez":
+        return pvlib.irradiance.perez(tilt, orientation, dhi, dni, dni_extra, zenith, azimuth, irr_["airmass"])
+    raise ValueError(f"Unknown transposition model {model!r}, choose from {TRANSPOSITION_MODELS}")
+
+def _error_stats(modelled, measured):
+    """Mean bias error and root mean square error of modelled against measured values."""
+    error = (modelled - measured).dropna()
+    return error.mean(), np.sqrt((error ** 2).mean())
+
+def compare_models(irr_, tilt, orientation, decompositions=DECOMPOSITION_MODELS, transpositions=TRANSPOSITION_MODELS,
+                   altitude=130):
+    """
+    Compare decomposition and transposition models against the measured DHI in irr_ (from process_irradiance).
+    The airmass, beam projection onto the plane, cos(zenith) and ground reflection are worked out once and
+    shared by every model. Each decomposition is run once, and each transposition once per decomposition.
+    Returns MBE and RMSE of the modelled kd (DHI/GHI) for each decomposition and, for each combination, of the
+    in-plane irradiance against the same transposition model run on the measured DNI/DHI.
+    """
+    # Only keep rows where kd is meaningful
+    irr_ = irr_[(irr_["ghi"] >= COMPARE_MIN_GHI) & (irr_["zenith"] <= COMPARE_MAX_ZENITH)].copy()
+    # Shared intermediates
+    pressure = pvlib.atmosphere.alt2pres(altitude)
+    irr_["cos_zenith"] = np.cos(np.radians(irr_["zenith"]))
+    irr_["airmass"] = pvlib.atmosphere.get_relative_airmass(irr_["apparent_zenith"])
+    projection = pvlib.irradiance.aoi_projection(tilt, orientation, irr_["zenith"], irr_["azimuth"])
+    irr_["projection_ratio"] = np.maximum(projection, 0) / np.maximum(irr_["cos_zenith"], 0.01745)
+    ground = pvlib.irradiance.get_ground_diffuse(tilt, irr_["ghi"], surface_type="urban")
+    measured_kd = irr_["dhi"] / irr_["ghi"]
+    # Split of the measured GHI into DNI and DHI, transposed with each model as the reference
+    measured_dni = ((irr_["ghi"] - irr_["dhi"]) / irr_["cos_zenith"]).clip(lower=0)
+    measured_beam = np.maximum(measured_dni * projection, 0)
+    reference = {model: measured_beam + _sky_diffuse(model, tilt, orientation, irr_, measured_dni, irr_["dhi"]) + ground
+                 for model in transpositions}
+    rows = []
+    for decomposition in decompositions:
+        dni, dhi = _decompose(decomposition, irr_, pressure)
+        kd_mbe, kd_rmse = _error_stats(dhi / irr_["ghi"], measured_kd)
+        beam = np.maximum(dni * projection, 0)
+        for transposition in transpositions:
+            poa = beam + _sky_diffuse(transposition, tilt, orientation, irr_, dni, dhi) + ground
+            poa_mbe, poa_rmse = _error_stats(poa, reference[transposition])
+            rows.append({"decomposition": decomposition, "transposition": transposition, "kd_mbe": kd_mbe,
+                         "kd_rmse": kd_rmse, "poa_mbe": poa_mbe, "poa_rmse": poa_rmse})
+    return pd.DataFrame(rows).set_index(["decomposition", "transposition"])
+
+def main_compare(testbed_data_file, lat, lon, orientation, tilt):
+    """Print the error statistics of every decomposition/transposition combination for the testbed data."""
+    irr = load_testbed_data(testbed_data_file)
+    irr_, kt, erbs, inplane = process_irradiance(irr, lat, lon, orientation, tilt)
+    stats = compare_models(irr_, tilt, orientation)
+    print(stats.to_string(float_format="{:.3f}".format))
+    return stats
+
+def main(testbed_data_file, lat, lon, orientation, tilt, headless=False, output_dir="figures", processes=None):
+    """
+    Run from command line.
+    With headless=True nothing is shown; every figure is written to `output_dir` as a PNG instead, rendered in
+    parallel by `processes` worker processes (default one per CPU).
+    """
+    if headless:
+        # Use a non-interactive backend so no display is needed
+        plt.switch_backend("Agg")
+    name = os.path.splitext(os.path.basename(testbed_data_file))[0]
+    # Load the pyranometer data from CSV
+    irr = load_testbed_data(testbed_data_file)
+    irr_, kt, erbs, inplane = process_irradiance(irr, lat, lon, orientation, tilt)
+    # Average to hourly, daily, weekly, monthly and annual in one go, and save the results so any of them can be
+    # looked at later without going back to the minute data
+    pyramid = aggregation_pyramid(pipeline_frame(irr_, kt, erbs, inplane))
+    save_pyramid(pyramid, pyramid_dir(testbed_data_file, lat, lon, orientation, tilt))
+    # Plot the daily averages (or change to "hourly", "weekly", "monthly" etc..)
+    erbs_d, irr_d, kt_d, inplane_d = split_pipeline_frame(pyramid_means(pyramid, "daily"))
+    if headless:
+        jobs = plot_jobs(erbs, irr_, inplane, name) + plot_jobs(erbs_d, irr_d, inplane_d, name + "_daily")
+        return plot_utils.render_figures(jobs, output_dir, processes=processes)
     # Make some plots...
     produce_plots2(erbs, irr_, kt, inplane)
     plt.show()
-    # Resample to hourly (or daily if change to "d", weeekly, monthly etc..) by averaging
-    inplane_d = inplane.resample("d", label="left").mean()
-    erbs_d = erbs.resample("d", label="left").mean()
-    kt_d = kt.resample("d", label="left").mean()
-    irr_d = irr_.resample("d", label="left").mean()
+    produce_plots2(erbs_d, irr_d, kt_d, inplane_d)
+    plt.show()
+
+def main_batch(runs, output_dir="figures", processes=None):
+    """
+    Run main headless for several sites/files, given as a list of (testbed_data_file, lat, lon, orientation, tilt).
+    The analysis runs one file at a time but the figures of every run are rendered together in one process pool.
+    """
+    plt.switch_backend("Agg")
+    jobs = []
+    for testbed_data_file, lat, lon, orientation, tilt in runs:
+        # Name the figures after the file and orientation, so runs of the same file do not overwrite each other
+        name = f"{os.path.splitext(os.path.basename(testbed_data_file))[0]}_{orientation:g}_{tilt:g}"
+        irr_, kt, erbs, inplane = process_irradiance(load_testbed_data(testbed_data_file), lat, lon, orientation, tilt)
+        erbs_d, irr_d, kt_d, inplane_d = split_pipeline_frame(
+            pyramid_means(aggregation_pyramid(pipeline_frame(irr_, kt, erbs, inplane), levels=("daily",)), "daily"))
+        jobs += plot_jobs(erbs, irr_, inplane, name) + plot_jobs(erbs_d, irr_d, inplane_d, name + "_daily")
+    return plot_utils.render_figures(jobs, output_dir, processes=processes)
+
+def main_chunked(testbed_data_file, lat, lon, orientation, tilt, chunk_days=7, headless=False, output_dir="figures",
+                 processes=None):
+    """
+    Run the same analysis as main on data too large to load at once.
+    The file is processed `chunk_days` at a time and only the hourly sums and counts of each chunk are kept. The
+    minute data of one chunk is all that is ever held, and what grows with the length of the archive is the hourly
+    level (hours x columns, about 8760 x 13 values a year). The chunks are combined into the full aggregation
+    pyramid at the end, which gives the same averages as main.
+    With headless=True the daily figures are written to `output_dir` instead of being shown, as in main.
+    """
+    if headless:
+        plt.switch_backend("Agg")
+    name = os.path.splitext(os.path.basename(testbed_data_file))[0]
+    pyramids = []
+    for irr in iter_testbed_data(testbed_data_file, chunk_days=chunk_days):
+        irr_, kt, erbs, inplane = process_irradiance(irr, lat, lon, orientation, tilt)
+        pyramids.append(aggregation_pyramid(pipeline_frame(irr_, kt, erbs, inplane), levels=("hourly",)))
+    pyramid = combine_pyramids(pyramids)
+    save_pyramid(pyramid, pyramid_dir(testbed_data_file, lat, lon, orientation, tilt))
+    erbs_d, irr_d, kt_d, inplane_d = split_pipeline_frame(pyramid_means(pyramid, "daily"))
+    if headless:
+        return plot_utils.render_figures(plot_jobs(erbs_d, irr_d, inplane_d, name + "_daily"), output_dir,
+                                         processes=processes)
     produce_plots2(erbs_d, irr_d, kt_d, inplane_d)
     plt.show()
 
@@ -125,5 +641,7 @@ if __name__ == "__main__":
     lon = -1.15
     ori = 225
     tilt = 35
+    # Set to True to save the figures to "figures/" instead of showing them (no display needed)
+    headless = False
     ##########################
-    main(testbed_data_file, lat, lon, ori, tilt)
+    main(testbed_data_file, lat, lon, ori, tilt, headless=headless)
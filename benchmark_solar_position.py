@@ -0,0 +1,57 @@
+"""
+Benchmark the solar position engines in solar_geometry.py.
+Reports throughput (timestamps per second) and the maximum zenith, apparent zenith and azimuth error against the
+NumPy NREL SPA for the Sheffield testbed and the Hong Kong (ninja_pv) sites. Errors are only counted while the sun
+is up.
+"""
+
+import importlib.util
+import time
+import numpy as np
+import pandas as pd
+import solar_geometry
+
+def benchmark_engine(times, lat, lon, altitude, engine, reference):
+    """Time one engine and compare it with the reference solar position."""
+    start = time.perf_counter()
+    geometry = solar_geometry.calculate_geometry(times, lat, lon, altitude=altitude, engine=engine)
+    elapsed = time.perf_counter() - start
+    daylight = reference["zenith"] < 90
+    zenith_error = np.abs(geometry["zenith"] - reference["zenith"])[daylight].max()
+    # The apparent zenith (with refraction) is what the EAI and kt calculations use
+    apparent_error = np.abs(geometry["apparent_zenith"] - reference["apparent_zenith"])[daylight].max()
+    # Azimuth differences wrap around at 360 degrees
+    azimuth_error = np.abs((geometry["azimuth"] - reference["azimuth"] + 180) % 360 - 180)[daylight].max()
+    return {"engine": engine, "timestamps/s": len(times) / elapsed, "max zenith error (deg)": zenith_error,
+            "max apparent zenith error (deg)": apparent_error, "max azimuth error (deg)": azimuth_error}
+
+def main(sites, year=2020, freq="1min"):
+    """Run every available engine over a year of timestamps at each site and print a table of results."""
+    times = pd.date_range(start=f"{year}-01-01", end=f"{year + 1}-01-01", freq=freq, tz="UTC", inclusive="left")
+    engines = [engine for engine in solar_geometry.ENGINES if engine != "spa"]
+    if importlib.util.find_spec("numba") is None:
+        # pvlib silently falls back to NumPy without numba, which would make the comparison meaningless
+        print("numba is not installed, skipping the numba engine")
+        engines.remove("numba")
+    results = []
+    for name, (lat, lon, altitude) in sites.items():
+        start = time.perf_counter()
+        reference = solar_geometry.calculate_geometry(times, lat, lon, altitude=altitude, engine="spa")
+        results.append({"site": name, "engine": "spa", "timestamps/s": len(times) / (time.perf_counter() - start),
+                        "max zenith error (deg)": 0.0, "max apparent zenith error (deg)": 0.0,
+                        "max azimuth error (deg)": 0.0})
+        for engine in engines:
+            results.append({"site": name, **benchmark_engine(times, lat, lon, altitude, engine, reference)})
+    results = pd.DataFrame(results).set_index(["site", "engine"])
+    print(results.to_string(float_format="{:.4g}".format))
+    return results
+
+if __name__ == "__main__":
+    #### CONFIG / INPUTS #####
+    # (latitude, longitude, altitude in m)
+    sites = {"Sheffield": (53.23, -1.15, 130),
+             "Hong Kong (ninja_pv)": (21.2163, 113.7704, 0)}
+    year = 2020
+    freq = "1min"
+    ##########################
+    main(sites, year=year, freq=freq)
@@ -0,0 +1,34 @@
+"""
+Helpers for writing the on-disk caches, shared by POA_analysis.py, solar_geometry.py, spectral_library.py and
+spectrum_to_Jsc.
+Everything is written under a temporary name and then renamed into place, so an interrupted run never leaves a
+half-written cache behind for a later run to load.
+"""
+
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+
+def save_npz(filename, **arrays):
+    """Save arrays to a .npz file (uncompressed) via a temporary file."""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp_file = filename + ".tmp"
+    # Write through a file object, as np.savez would add ".npz" to the temporary name
+    with open(tmp_file, "wb") as fid:
+        np.savez(fid, **arrays)
+    os.replace(tmp_file, filename)
+
+@contextmanager
+def replace_directory(directory):
+    """
+    Yield a temporary directory to write into, which replaces `directory` (if it exists) once the block finishes.
+    If the block raises, `directory` is left as it was.
+    """
+    tmp_dir = directory + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    yield tmp_dir
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_dir, directory)
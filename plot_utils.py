@@ -0,0 +1,198 @@
+"""
+Plotting helpers for large irradiance data sets, shared by POA_analysis.py and Calculate_KT.py.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib.colors as mcolors
+from scipy.ndimage import map_coordinates
+from scipy.signal import fftconvolve
+
+# Above this many points scatter plots are drawn as a density image instead
+DENSITY_THRESHOLD = 10000
+
+def density_plot(ax, x, y, bins=200, mode="hist2d", log=True, cmap="viridis", range=None):
+    """
+    Draw the density of (x, y) points on `ax` instead of the individual points.
+    "hist2d" bins the points with np.histogram2d and draws the counts as one image, "hexbin" uses hexagonal
+    bins. Either way the cost of drawing does not depend on the number of points. NaN/inf points are dropped,
+    as are points outside `range` ((xmin, xmax), (ymin, ymax)) if it is given.
+    Returns the artist so a colorbar can be added.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if range is not None:
+        finite &= (x >= range[0][0]) & (x <= range[0][1]) & (y >= range[1][0]) & (y <= range[1][1])
+    x = x[finite]
+    y = y[finite]
+    norm = mcolors.LogNorm() if log else None
+    if mode == "hexbin":
+        extent = None if range is None else (*range[0], *range[1])
+        return ax.hexbin(x, y, gridsize=bins // 2, mincnt=1, norm=norm, cmap=cmap, extent=extent)
+    if mode != "hist2d":
+        raise ValueError(f"Unknown density mode {mode!r}, choose 'hist2d' or 'hexbin'")
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins, range=range)
+    # Leave empty bins transparent
+    counts = np.ma.masked_equal(counts, 0)
+    return ax.imshow(counts.T, origin="lower", aspect="auto", interpolation="nearest", norm=norm, cmap=cmap,
+                     extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]))
+
+def _linear_bin(values, lo, hi, gridsize):
+    """Spread each value over its two nearest grid points in proportion to distance (linear binning)."""
+    position = (values - lo) / (hi - lo) * (gridsize - 1)
+    left = np.clip(np.floor(position).astype(int), 0, gridsize - 2)
+    weight = position - left
+    return left, weight
+
+def _gaussian_kernel(bandwidth, delta, gridsize):
+    """Gaussian kernel sampled on the grid spacing out to four bandwidths, normalised to sum to one."""
+    half_width = int(min(np.ceil(4 * bandwidth / delta), gridsize - 1))
+    offsets = np.arange(-half_width, half_width + 1) * delta
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    return kernel / kernel.sum()
+
+def _finite_range(values, value_range):
+    """Return the (lo, hi) grid limits, from the data unless given."""
+    if value_range is not None:
+        return value_range
+    lo, hi = values.min(), values.max()
+    # Avoid a zero-width grid when every value is the same
+    return (lo, hi) if hi > lo else (lo - 0.5, hi + 0.5)
+
+def binned_kde(x, gridsize=512, bandwidth=None, range=None):
+    """
+    Fast Gaussian kernel density estimate of `x` on a regular grid of `gridsize` points.
+    The data are linearly binned onto the grid and convolved with the kernel by FFT, so the cost is O(N) in the
+    number of points (plus O(G log G) in the grid) rather than O(N^2) for scipy.stats.gaussian_kde.
+    `bandwidth` is the kernel standard deviation in the units of x (Scott's rule if None). Points outside `range`
+    (lo, hi) are ignored. Returns the grid and the density on it.
+    """
+    x = np.asarray(x, dtype=float)
+    x = x[np.isfinite(x)]
+    lo, hi = _finite_range(x, range)
+    x = x[(x >= lo) & (x <= hi)]
+    if bandwidth is None:
+        bandwidth = x.std() * len(x) ** (-1 / 5)
+    grid = np.linspace(lo, hi, gridsize)
+    delta = grid[1] - grid[0]
+    left, weight = _linear_bin(x, lo, hi, gridsize)
+    counts = np.bincount(left, 1 - weight, minlength=gridsize) + np.bincount(left + 1, weight, minlength=gridsize)
+    density = fftconvolve(counts, _gaussian_kernel(bandwidth, delta, gridsize), mode="same")
+    return grid, np.clip(density, 0, None) / (len(x) * delta)
+
+def binned_kde_2d(x, y, gridsize=256, bandwidth=None, range=None):
+    """
+    Fast 2-D Gaussian kernel density estimate on a regular gridsize x gridsize grid, as binned_kde.
+    `bandwidth` is (bandwidth_x, bandwidth_y) in data units (Scott's rule if None) and `range` is
+    ((xmin, xmax), (ymin, ymax)). Returns the x grid, the y grid and the density with shape (len(x grid), len(y grid)).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x = x[finite]
+    y = y[finite]
+    (x_lo, x_hi), (y_lo, y_hi) = (_finite_range(x, None), _finite_range(y, None)) if range is None else range
+    inside = (x >= x_lo) & (x <= x_hi) & (y >= y_lo) & (y <= y_hi)
+    x = x[inside]
+    y = y[inside]
+    if bandwidth is None:
+        bandwidth = (x.std() * len(x) ** (-1 / 6), y.std() * len(y) ** (-1 / 6))
+    x_grid = np.linspace(x_lo, x_hi, gridsize)
+    y_grid = np.linspace(y_lo, y_hi, gridsize)
+    dx = x_grid[1] - x_grid[0]
+    dy = y_grid[1] - y_grid[0]
+    x_left, x_weight = _linear_bin(x, x_lo, x_hi, gridsize)
+    y_left, y_weight = _linear_bin(y, y_lo, y_hi, gridsize)
+    counts = np.zeros(gridsize * gridsize)
+    for x_step, x_share in ((0, 1 - x_weight), (1, x_weight)):
+        for y_step, y_share in ((0, 1 - y_weight), (1, y_weight)):
+            counts += np.bincount((x_left + x_step) * gridsize + y_left + y_step, x_share * y_share,
+                                  minlength=gridsize * gridsize)
+    kernel = np.outer(_gaussian_kernel(max(bandwidth[0], 1e-12), dx, gridsize),
+                      _gaussian_kernel(max(bandwidth[1], 1e-12), dy, gridsize))
+    density = fftconvolve(counts.reshape(gridsize, gridsize), kernel, mode="same")
+    return x_grid, y_grid, np.clip(density, 0, None) / (len(x) * dx * dy)
+
+def kde_at_points(x, y, gridsize=256, bandwidth=None, range=None):
+    """Return the binned 2-D KDE interpolated (bilinearly) back to each (x, y) point, NaN for dropped points."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_grid, y_grid, density = binned_kde_2d(x, y, gridsize=gridsize, bandwidth=bandwidth, range=range)
+    values = np.full(len(x), np.nan)
+    keep = np.isfinite(x) & np.isfinite(y) & (x >= x_grid[0]) & (x <= x_grid[-1]) & (y >= y_grid[0]) & (y <= y_grid[-1])
+    coords = np.vstack([(x[keep] - x_grid[0]) / (x_grid[1] - x_grid[0]), (y[keep] - y_grid[0]) / (y_grid[1] - y_grid[0])])
+    values[keep] = map_coordinates(density, coords, order=1)
+    return values
+
+def kde_scatter(ax, x, y, gridsize=256, bandwidth=None, range=None, log=True, cmap="viridis", s=2):
+    """Scatter plot of (x, y) coloured by point density (from kde_at_points), densest points drawn on top."""
+    density = kde_at_points(x, y, gridsize=gridsize, bandwidth=bandwidth, range=range)
+    keep = np.isfinite(density) & (density > 0)
+    order = np.argsort(density[keep])
+    x = np.asarray(x, dtype=float)[keep][order]
+    y = np.asarray(y, dtype=float)[keep][order]
+    norm = mcolors.LogNorm() if log else None
+    return ax.scatter(x, y, c=density[keep][order], s=s, norm=norm, cmap=cmap, edgecolor="none")
+
+def minmax_decimate(series, n_buckets):
+    """
+    Reduce a time series to the first, last, minimum and maximum point of each of `n_buckets` equal time buckets.
+    Drawn as a line this looks the same as the full series when there is one bucket per pixel column, as every
+    peak and ramp is kept. Gaps (NaNs) are kept as one NaN point at the start of each gap and in each bucket
+    the gap covers, so the line still breaks where the data are missing.
+    """
+    if len(series) <= 4 * n_buckets:
+        return series
+    x = series.index.asi8 if hasattr(series.index, "asi8") else np.asarray(series.index, dtype=float)
+    bucket = ((x - x[0]) / (x[-1] - x[0]) * (n_buckets - 1)).astype(int)
+    values = series.to_numpy(dtype=float)
+    missing = np.isnan(values)
+    gaps = np.flatnonzero(missing)
+    gaps = gaps[np.r_[True, (np.diff(gaps) > 1) | (bucket[gaps][1:] != bucket[gaps][:-1])]] if len(gaps) else gaps
+    rows = np.flatnonzero(~missing)
+    if len(rows) == 0:
+        return series.iloc[gaps]
+    bucket = bucket[rows]
+    # Sort by bucket then value, so each bucket's minimum comes first and its maximum last
+    order = np.lexsort((values[rows], bucket))
+    starts = np.flatnonzero(np.r_[True, bucket[order][1:] != bucket[order][:-1]])
+    ends = np.r_[starts[1:], len(order)] - 1
+    # The data are in time order, so the first and last of each bucket are at its edges
+    edges = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    keep = np.concatenate([order[starts], order[ends], edges, np.r_[edges[1:] - 1, len(rows) - 1]])
+    return series.iloc[np.union1d(rows[keep], gaps)]
+
+def plot_decimated(series, ax, n_buckets=None, **kwargs):
+    """
+    Plot a (time) series on `ax` after minmax_decimate, with one bucket per pixel of the axes width by default.
+    Other keyword arguments are passed on to Series.plot. Returns the axes.
+    """
+    if n_buckets is None:
+        n_buckets = max(int(ax.bbox.width), 1)
+    return minmax_decimate(series, n_buckets).plot(ax=ax, **kwargs)
+
+def _render_figure(path, plot_function, args):
+    """Draw one figure with a non-interactive backend and save it (runs in a worker process)."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    fig = plot_function(*args)
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+def render_figures(jobs, output_dir, processes=None):
+    """
+    Render figures to files in parallel.
+    `jobs` is a list of (filename, plot function, arguments), where the plot function draws and returns a figure.
+    Functions and arguments must be picklable (module level functions and pandas/NumPy data are fine). Each
+    figure is drawn in one of `processes` worker processes (default one per CPU) and saved as
+    output_dir/filename. Returns the paths written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_render_figure, os.path.join(output_dir, filename), plot_function, args)
+                   for filename, plot_function, args in jobs]
+        return [future.result() for future in futures]
@@ -0,0 +1,129 @@
+"""
+Disk-backed cache of solar geometry and extraterrestrial irradiance.
+The solar position only depends on the site and the timestamps, so a whole year is calculated once per
+(site, year, frequency) and saved as .npy files. Later runs open these with np.memmap and just pick out
+the rows they need. Only the most recently used entries are kept on disk.
+"""
+
+import os
+import shutil
+import importlib.util
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import pvlib
+from scipy.interpolate import CubicSpline
+import cache_utils
+
+CACHE_DIR = os.path.join("cache", "solar_geometry")
+# Number of (site, year, frequency) entries kept on disk before the least recently used is deleted
+MAX_CACHE_ENTRIES = 16
+FIELDS = ("zenith", "apparent_zenith", "azimuth", "eai_global")
+
+# Solar position engines: the NREL SPA in NumPy (reference) or compiled with numba, pvlib's low order
+# ephemeris, or the SPA on a coarse grid interpolated to the requested times
+ENGINES = ("spa", "numba", "ephemeris", "interp")
+# Grid spacing used by the "interp" engine
+INTERP_STEP = "10min"
+
+def _interpolated_solpos(times, loc, temperature):
+    """Run the SPA on a coarse grid and interpolate it to `times`."""
+    step = pd.tseries.frequencies.to_offset(INTERP_STEP)
+    # Pad the grid by two steps either side so the spline is well behaved at the ends
+    grid = pd.date_range(start=times.min().floor(step) - 2 * step, end=times.max().ceil(step) + 2 * step,
+                         freq=step, tz="UTC")
+    coarse = loc.get_solarposition(grid, temperature=temperature)
+    # Interpolate the sun's unit vector rather than the angles, so azimuth wraps correctly
+    zen = np.radians(coarse["zenith"].to_numpy())
+    azi = np.radians(coarse["azimuth"].to_numpy())
+    vectors = np.stack([np.sin(zen) * np.sin(azi), np.sin(zen) * np.cos(azi), np.cos(zen)], axis=-1)
+    x, y, z = CubicSpline(grid.asi8, vectors, axis=0)(times.asi8).T
+    zenith = np.degrees(np.arctan2(np.hypot(x, y), z))
+    azimuth = np.degrees(np.arctan2(x, y)) % 360
+    # Refraction switches off just below the horizon, so a spline through it overshoots there. Work it out from
+    # the interpolated zenith instead, with the same correction (and pressure) as the SPA
+    pressure = pvlib.atmosphere.alt2pres(loc.altitude) / 100
+    refraction = pvlib.spa.atmospheric_refraction_correction(pressure, temperature, 90 - zenith, 0.5667)
+    return pd.DataFrame({"zenith": zenith, "apparent_zenith": zenith - refraction, "azimuth": azimuth}, index=times)
+
+def calculate_geometry(times, lat, lon, altitude=0, temperature=12, engine="spa"):
+    """Calculate the solar position and (site independent) EAI for the given times without caching."""
+    loc = pvlib.location.Location(lat, lon, tz="UTC", altitude=altitude)
+    if engine == "spa":
+        solpos = loc.get_solarposition(times, temperature=temperature)
+    elif engine == "numba":
+        # pvlib only warns and falls back to NumPy without numba, which would be cached under the wrong engine
+        if importlib.util.find_spec("numba") is None:
+            raise ValueError("The numba solar position engine needs numba to be installed")
+        solpos = loc.get_solarposition(times, temperature=temperature, method="nrel_numba")
+    elif engine == "ephemeris":
+        solpos = loc.get_solarposition(times, temperature=temperature, method="ephemeris")
+    elif engine == "interp":
+        solpos = _interpolated_solpos(times, loc, temperature)
+    else:
+        raise ValueError(f"Unknown solar position engine {engine!r}, choose from {ENGINES}")
+    geometry = solpos[["zenith", "apparent_zenith", "azimuth"]].copy()
+    geometry["eai_global"] = pvlib.irradiance.get_extra_radiation(times)
+    return geometry
+
+def _entry_dir(cache_dir, lat, lon, altitude, temperature, year, freq, engine):
+    """Name the cache directory for one site, year, time grid and engine."""
+    key = f"{lat:.5f}_{lon:.5f}_{altitude:g}_{temperature:g}_{year}_{pd.tseries.frequencies.to_offset(freq).freqstr}_{engine}"
+    return os.path.join(cache_dir, key)
+
+@lru_cache(maxsize=8)
+def _open_entry(entry_dir):
+    """Open the arrays of a cache entry as read-only memory maps."""
+    return {field: np.load(os.path.join(entry_dir, field + ".npy"), mmap_mode="r") for field in FIELDS}
+
+def _evict(cache_dir, max_entries):
+    """Delete the least recently used entries so at most `max_entries` remain."""
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if not name.endswith(".tmp")]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for entry_dir in entries[max_entries:]:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+def year_geometry(lat, lon, year, freq="1min", altitude=0, temperature=12, engine="spa", cache_dir=CACHE_DIR,
+                  max_entries=MAX_CACHE_ENTRIES):
+    """
+    Return the solar geometry for every `freq` step of a (UTC) year as a dict of memory-mapped arrays.
+    The arrays are calculated and written to `cache_dir` the first time they are asked for.
+    """
+    entry_dir = _entry_dir(cache_dir, lat, lon, altitude, temperature, year, freq, engine)
+    if not os.path.isdir(entry_dir):
+        times = pd.date_range(start=f"{year}-01-01", end=f"{year + 1}-01-01", freq=freq, tz="UTC", inclusive="left")
+        geometry = calculate_geometry(times, lat, lon, altitude=altitude, temperature=temperature, engine=engine)
+        with cache_utils.replace_directory(entry_dir) as tmp_dir:
+            for field in FIELDS:
+                np.save(os.path.join(tmp_dir, field + ".npy"), geometry[field].to_numpy(dtype=np.float64))
+        _evict(cache_dir, max_entries)
+    else:
+        # Mark the entry as recently used
+        os.utime(entry_dir)
+    return _open_entry(entry_dir)
+
+def get_solar_geometry(times, lat, lon, altitude=0, temperature=12, freq="1min", engine="spa", cache_dir=CACHE_DIR):
+    """
+    Return zenith, apparent_zenith, azimuth and eai_global at the given UTC times, using one of ENGINES.
+    Times on the regular `freq` grid are read from the cache. If any timestamp falls between grid points
+    (or cache_dir is None) everything is calculated directly instead.
+    """
+    times = pd.DatetimeIndex(times).tz_convert("UTC")
+    step = pd.Timedelta(pd.tseries.frequencies.to_offset(freq)).value
+    years = times.year.to_numpy()
+    unique_years = np.unique(years)
+    year_starts = np.array([pd.Timestamp(year=int(year), month=1, day=1, tz="UTC").value for year in unique_years],
+                           dtype=np.int64)
+    # Position of each timestamp within its year, in steps of `freq`
+    offsets = times.asi8 - year_starts[np.searchsorted(unique_years, years)]
+    if cache_dir is None or len(times) == 0 or np.any(offsets % step):
+        return calculate_geometry(times, lat, lon, altitude=altitude, temperature=temperature, engine=engine)
+    rows = offsets // step
+    result = {field: np.empty(len(times)) for field in FIELDS}
+    for year in unique_years:
+        in_year = years == year
+        arrays = year_geometry(lat, lon, int(year), freq=freq, altitude=altitude, temperature=temperature,
+                               engine=engine, cache_dir=cache_dir)
+        for field in FIELDS:
+            result[field][in_year] = arrays[field][rows[in_year]]
+    return pd.DataFrame(result, index=times)
@@ -0,0 +1,122 @@
+"""
+Compact binary library of spectra (irradiance spectra and EQE curves) on one registered wavelength grid.
+Each spectrum is resampled once and stored as a float32 row of spectra.npy, next to the grid (wavelength.npy)
+and a metadata index (index.csv). Scripts open the library with np.memmap, so any spectrum, or a block of
+thousands, is read straight from disk without parsing a CSV or copying the whole library.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.interpolate import make_interp_spline, BSpline
+import cache_utils
+
+LIBRARY_DIR = os.path.join("cache", "spectral_library")
+# The registered grid (nm): covers the EQE files (from 200 nm) and the AM1.5 spectrum (to 4000 nm)
+START_WL = 200
+END_WL = 4000
+STEP_WL = 1
+
+# The two column spectrum CSVs shipped with the repo, by library name
+SOURCES = {"AM1.5": "AM15_G_raw.csv",
+           "Cloudy": "G_spectrum.csv",
+           "eqe_spectrum": "eqe_spectrum.csv",
+           "eqe_spectrum2": "eqe_spectrum2.csv",
+           "eqe_spectrum3": "eqe_spectrum3.csv"}
+
+def wavelength_grid(start_wl, end_wl, step_wl):
+    """Return the wavelengths from start_wl to end_wl (inclusive) in steps of step_wl."""
+    return start_wl + step_wl * np.arange(int(round((end_wl - start_wl) / step_wl)) + 1)
+
+def load_spectrum(filename):
+    """
+    Load a two column spectrum CSV (wavelength in nm, then the value) with a one row header.
+    Blank rows are dropped. Returns the wavelength and value columns as 1D arrays.
+    """
+    data = pd.read_csv(filename).dropna()
+    return data.iloc[:, 0].to_numpy(dtype=float), data.iloc[:, 1].to_numpy(dtype=float)
+
+def spectrum_spline(wavelength, values):
+    """
+    Fit a cubic spline (the same not-a-knot spline as interp1d(kind='cubic')) to a spectrum.
+    The coefficients are worked out once, so the returned spline can be evaluated on any grid without refitting.
+    """
+    return make_interp_spline(wavelength, values, k=3)
+
+def resample_spectra(spectra, start_wl, end_wl, step_wl, fill_value=np.nan):
+    """
+    Resample many spectra onto one shared wavelength grid.
+    `spectra` is a list whose items are (wavelength, values) array pairs or splines from spectrum_spline (fit these
+    once and pass them in when resampling the same sources more than once). Points of the grid outside a
+    spectrum's wavelength range are set to `fill_value`.
+    Returns the grid and a 2-D array with one resampled spectrum per row.
+    """
+    grid = wavelength_grid(start_wl, end_wl, step_wl)
+    resampled = np.empty((len(spectra), len(grid)))
+    for row, spectrum in enumerate(spectra):
+        spline = spectrum if isinstance(spectrum, BSpline) else spectrum_spline(*spectrum)
+        # The knots span the range of the data, so only evaluate inside it
+        inside = (grid >= spline.t[0]) & (grid <= spline.t[-1])
+        resampled[row] = fill_value
+        resampled[row, inside] = spline(grid[inside])
+    return grid, resampled
+
+def build_library(sources=SOURCES, library_dir=LIBRARY_DIR, start_wl=START_WL, end_wl=END_WL, step_wl=STEP_WL):
+    """
+    Build a library from two column spectrum CSVs, given as {name: filename}.
+    Each spectrum is resampled onto the grid with resample_spectra (a cubic spline) and is NaN outside the
+    range of its file. The library is written to a temporary directory and renamed into place, so an interrupted
+    build never leaves a partial library. Returns the opened library.
+    """
+    source_spectra = [load_spectrum(filename) for filename in sources.values()]
+    wavelength, spectra = resample_spectra(source_spectra, start_wl, end_wl, step_wl)
+    spectra = spectra.astype(np.float32)
+    index = []
+    for row, (name, filename) in enumerate(sources.items()):
+        source_wl = source_spectra[row][0]
+        index.append({"name": name, "row": row, "file": filename, "label": pd.read_csv(filename, nrows=0).columns[1],
+                      "start_wl": source_wl[0], "end_wl": source_wl[-1], "mtime": os.path.getmtime(filename)})
+    with cache_utils.replace_directory(library_dir) as tmp_dir:
+        np.save(os.path.join(tmp_dir, "wavelength.npy"), wavelength)
+        np.save(os.path.join(tmp_dir, "spectra.npy"), spectra)
+        pd.DataFrame(index).to_csv(os.path.join(tmp_dir, "index.csv"), index=False)
+    return open_library(library_dir)
+
+def open_library(library_dir=LIBRARY_DIR):
+    """
+    Open a library as a dict: "wavelength" (the grid), "spectra" (a read-only memmap with one spectrum per row)
+    and "index" (the metadata, indexed by name).
+    """
+    return {"wavelength": np.load(os.path.join(library_dir, "wavelength.npy")),
+            "spectra": np.load(os.path.join(library_dir, "spectra.npy"), mmap_mode="r"),
+            "index": pd.read_csv(os.path.join(library_dir, "index.csv"), index_col="name")}
+
+def load_library(sources=SOURCES, library_dir=LIBRARY_DIR, **grid):
+    """
+    Open the library, building it first if it does not exist yet, if the sources have changed (names, files or
+    modification times) or if the grid does not match `grid` (start_wl, end_wl, step_wl).
+    """
+    grid = {"start_wl": START_WL, "end_wl": END_WL, "step_wl": STEP_WL, **grid}
+    if os.path.isdir(library_dir):
+        library = open_library(library_dir)
+        index = library["index"]
+        wavelength = library["wavelength"]
+        up_to_date = (list(index.index) == list(sources) and list(index["file"]) == list(sources.values())
+                      and all(index["mtime"] == [os.path.getmtime(f) for f in sources.values()])
+                      and np.isclose(wavelength[0], grid["start_wl"]) and np.isclose(wavelength[-1], grid["end_wl"])
+                      and np.isclose(wavelength[1] - wavelength[0], grid["step_wl"]))
+        if up_to_date:
+            return library
+    return build_library(sources, library_dir, **grid)
+
+def get_spectra(library, names):
+    """
+    Return the spectra with the given names, one per row (or a single spectrum for a single name).
+    Names in one consecutive run of rows are returned as a view of the memmap, anything else is copied.
+    """
+    if isinstance(names, str):
+        return library["spectra"][library["index"].loc[names, "row"]]
+    rows = library["index"].loc[list(names), "row"].to_numpy()
+    if len(rows) and np.all(np.diff(rows) == 1):
+        return library["spectra"][rows[0]:rows[-1] + 1]
+    return library["spectra"][rows]
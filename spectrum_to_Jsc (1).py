@@ -4,62 +4,429 @@ Demo script to interpolate spectral data.
 - First Authored: 2020-06-24
 """
 
+import os
+import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import pandas as pd
 import numpy as np
 import scipy
 import matplotlib.pyplot as plt
-from scipy.interpolate import interp1d
+from scipy.interpolate import RegularGridInterpolator
+import pvlib
+import spectral_library
+import cache_utils
+from spectral_library import load_spectrum, resample_spectra
 
 def interpolate_wl_spectrum(start_wl, end_wl, step_wl, input_spectrum):
     """
     Takes a csv spectrum file (input spectrum) with one row header and two columns (columns are "wavelength" in nm and "power") and interpolates with fixed "step_wl"
     wl stands for wavelength. x is wavelength axis and y is power axis. 
     a cubic spline is chosen
-    The interpolation function operates on independent x and y 1D arrays so the first thing to do is split the data frame into these arrays by deleting the other column from the data frame. They then need converting to a 1D array using ".ravel()"
-    Then the new x variable can be defined as int_x by taking a equal step from the start wavelength "start_wl" to the end wavelength "end_wl". 
-    A function "f" is fitted using the spline method for all x and y.
-    Then a new set of y (int_y) are created using the new x values (int_x) and the function "f"
+    The interpolation function operates on independent x and y 1D arrays so the first thing to do is take the two columns of the data frame as these arrays.
+    Then the new x variable can be defined as int_x by taking a equal step "step_wl" from the start wavelength "start_wl" to the end wavelength "end_wl". 
+    A function "f" is fitted using the spline method for all x and y (resample_spectra in spectral_library.py does both steps).
+    Then a new set of y (int_y) are created using the new x values (int_x) and the function "f". Any int_x outside the data is NaN.
     Finally the new x and y values (int_x, int_y) are added to a new dataframe "df"
-    I have no idea why "axis=-1" is needed!
-    """
-    #converting to matrix
-    conv_spectrum = input_spectrum.values
-    #converting matrix columns to 1d array
-    x = np.delete(conv_spectrum,[1],axis=1)
-    y = np.delete(conv_spectrum,[0],axis=1)
-    #converting to 1D array
-    x = x.ravel()
-    y = y.ravel()
-    int_x = np.linspace(start_wl, end_wl, (end_wl-start_wl+1))
-    f = interp1d(x, y, kind='cubic')
-    int_y = f(int_x)
+    "axis=-1" stacks int_x and int_y side by side as columns (rather than one after the other as rows).
+    To resample many spectra at once use resample_spectra directly.
+    """
+    #splitting the two columns into 1D arrays
+    x = input_spectrum.iloc[:, 0].to_numpy(dtype=float)
+    y = input_spectrum.iloc[:, 1].to_numpy(dtype=float)
+    int_x, (int_y,) = resample_spectra([(x, y)], start_wl, end_wl, step_wl)
     df = pd.DataFrame(np.stack((int_x, int_y), axis=-1))
     return df
-    
+
+# Planck constant (J s), speed of light (m/s) and elementary charge (C)
+PLANCK = 6.62607015e-34
+LIGHT_SPEED = 2.99792458e8
+CHARGE = 1.602176634e-19
+# hc in eV nm, to convert a photon energy in eV to a wavelength in nm
+HC_EV_NM = PLANCK * LIGHT_SPEED / CHARGE * 1e9
+
+def photon_flux(wavelength, irradiance):
+    """
+    Convert a spectral irradiance (W m^-2 nm^-1) to a spectral photon flux (photons s^-1 m^-2 nm^-1).
+    Each photon carries energy hc/wavelength, so the photon flux is irradiance * wavelength / (hc), with the
+    wavelength (in nm) converted to metres.
+    """
+    return np.asarray(irradiance) * np.asarray(wavelength) * 1e-9 / (PLANCK * LIGHT_SPEED)
+
+def trapezoid_weights(wavelength):
+    """Return the weights that integrate a function sampled at `wavelength` by the trapezium rule (dot product)."""
+    wavelength = np.asarray(wavelength, dtype=float)
+    steps = np.diff(wavelength)
+    weights = np.zeros_like(wavelength)
+    weights[:-1] += steps / 2
+    weights[1:] += steps / 2
+    return weights
+
+def jsc(wavelength, irradiance, eqe):
+    """
+    Calculate the short circuit current density (mA/cm^2) of one or many cells under a spectrum.
+    `irradiance` (W m^-2 nm^-1) and `eqe` (as a fraction, not %) must be on the same `wavelength` grid (nm).
+    `eqe` can be one curve or a 2-D array with one curve per row. The photon flux, the charge per photon and the
+    integration weights are combined into one vector, so every curve is scored by a single matrix-vector product.
+    """
+    # Current per unit EQE at each wavelength (A/m^2), converted to mA/cm^2 (1 A/m^2 = 0.1 mA/cm^2)
+    weights = CHARGE * photon_flux(wavelength, irradiance) * trapezoid_weights(wavelength) * 0.1
+    return np.asarray(eqe, dtype=float) @ weights
+
+def _linear_at(x, y, points):
+    """Evaluate the piecewise linear function through (x, y) at `points`; y may hold one curve per row."""
+    right = np.clip(np.searchsorted(x, points, side="right"), 1, len(x) - 1)
+    fraction = (points - x[right - 1]) / (x[right] - x[right - 1])
+    y = np.asarray(y, dtype=float)
+    return y[..., right - 1] * (1 - fraction) + y[..., right] * fraction
+
+def integrate_linear_product(*curves):
+    """
+    Integrate the product of up to three piecewise linear curves exactly, each on its own (native) grid.
+    Each curve is a (wavelength, values) pair, and `values` may be 2-D with one curve per row. The integral runs
+    over the wavelengths covered by every curve. On each interval between the merged grid points the product is
+    at most cubic, so Simpson's rule (ends and midpoint) is exact and no dense resampling is needed.
+    """
+    lo = max(np.min(x) for x, y in curves)
+    hi = min(np.max(x) for x, y in curves)
+    knots = np.unique(np.concatenate([np.asarray(x, dtype=float) for x, y in curves]))
+    knots = np.unique(np.r_[lo, knots[(knots > lo) & (knots < hi)], hi])
+    midpoints = (knots[1:] + knots[:-1]) / 2
+    at_knots = 1.0
+    at_midpoints = 1.0
+    for x, y in curves:
+        x = np.asarray(x, dtype=float)
+        at_knots = at_knots * _linear_at(x, y, knots)
+        at_midpoints = at_midpoints * _linear_at(x, y, midpoints)
+    steps = np.diff(knots)
+    return (at_knots[..., :-1] + 4 * at_midpoints + at_knots[..., 1:]) @ steps / 6
+
+def total_irradiance(wavelength, irradiance):
+    """Total irradiance (W/m^2) of a spectrum, integrated exactly on its native grid."""
+    return integrate_linear_product((wavelength, irradiance))
+
+def jsc_native(wavelength, irradiance, eqe_wavelength, eqe):
+    """
+    Calculate the short circuit current density (mA/cm^2) with the spectrum and EQE (as a fraction, one curve
+    or one per row) each on their own wavelength grids. The photon flux is irradiance * wavelength / hc, so the
+    integrand is the product of three piecewise linear functions (irradiance, wavelength and EQE), which
+    integrate_linear_product integrates exactly.
+    """
+    wavelength = np.asarray(wavelength, dtype=float)
+    integral = integrate_linear_product((wavelength, irradiance), (wavelength, wavelength), (eqe_wavelength, eqe))
+    return CHARGE * integral * 1e-9 / (PLANCK * LIGHT_SPEED) * 0.1
+
+def _partial_linear_product(x, a, b, index, upper):
+    """Exact integral from x[index] to `upper` of the product of the piecewise linear functions a and b."""
+    step = x[index + 1] - x[index]
+    t = (upper - x[index]) / step
+    a0, b0 = a[index], b[index]
+    da, db = a[index + 1] - a0, b[index + 1] - b0
+    return step * (a0 * b0 * t + (a0 * db + b0 * da) * t ** 2 / 2 + da * db * t ** 3 / 3)
+
+def cumulative_photon_flux(wavelength, irradiance):
+    """
+    Prefix sum of the photon flux (photons s^-1 m^-2) from the shortest wavelength up to each grid point.
+    The irradiance is taken as piecewise linear, so irradiance * wavelength is integrated exactly on each interval.
+    """
+    x = np.asarray(wavelength, dtype=float)
+    a = np.asarray(irradiance, dtype=float)
+    steps = np.diff(x)
+    segments = steps * (2 * a[:-1] * x[:-1] + a[:-1] * x[1:] + a[1:] * x[:-1] + 2 * a[1:] * x[1:]) / 6
+    return np.r_[0, np.cumsum(segments)] * 1e-9 / (PLANCK * LIGHT_SPEED)
+
+def jsc_vs_bandgap(wavelength, irradiance, bandgaps):
+    """
+    Calculate the ideal short circuit current density (mA/cm^2) for each bandgap in `bandgaps` (eV), assuming
+    every photon with more energy than the bandgap gives one electron (EQE = 1 below the cut-off wavelength).
+    The photon flux is summed once (cumulative_photon_flux) and each bandgap only needs the sum up to its
+    cut-off wavelength hc/Eg plus the exact part of the interval it falls in, so the whole sweep is O(N).
+    """
+    x = np.asarray(wavelength, dtype=float)
+    prefix = cumulative_photon_flux(x, irradiance)
+    # Cut-off wavelengths in nm, limited to the range of the spectrum
+    cutoff = np.clip(HC_EV_NM / np.asarray(bandgaps, dtype=float), x[0], x[-1])
+    index = np.clip(np.searchsorted(x, cutoff, side="right") - 1, 0, len(x) - 2)
+    flux = prefix[index] + _partial_linear_product(x, np.asarray(irradiance, dtype=float), x, index, cutoff) * 1e-9 / (PLANCK * LIGHT_SPEED)
+    return CHARGE * flux * 0.1
+
+def tandem_current_matching(wavelength, irradiance, top_bandgaps, bottom_bandgaps):
+    """
+    Calculate the current-matched Jsc (mA/cm^2) of an ideal two-junction (tandem) cell for every pair of top and
+    bottom bandgaps (eV). The top cell collects every photon above its bandgap and the bottom cell the photons
+    between the two bandgaps; in series the smaller of the two currents flows.
+    Both currents come from the same jsc_vs_bandgap curves, so the whole grid is a single broadcast operation.
+    Current alone always favours the smallest bottom bandgap, so rather than one overall best pair the best top
+    bandgap is found for each bottom bandgap.
+    Returns a 2-D array (top x bottom, NaN where the bottom bandgap is not below the top one), and for each bottom
+    bandgap the best top bandgap and its matched Jsc (NaN where no top bandgap is above it).
+    """
+    top_bandgaps = np.asarray(top_bandgaps, dtype=float)
+    bottom_bandgaps = np.asarray(bottom_bandgaps, dtype=float)
+    top_jsc = jsc_vs_bandgap(wavelength, irradiance, top_bandgaps)[:, np.newaxis]
+    # Everything above the bottom bandgap, less what the top cell has already taken
+    bottom_jsc = jsc_vs_bandgap(wavelength, irradiance, bottom_bandgaps)[np.newaxis, :] - top_jsc
+    matched = np.minimum(top_jsc, bottom_jsc)
+    matched[bottom_bandgaps[np.newaxis, :] >= top_bandgaps[:, np.newaxis]] = np.nan
+    valid = ~np.all(np.isnan(matched), axis=0)
+    best = np.argmax(np.nan_to_num(matched, nan=-np.inf), axis=0)
+    best_top = np.where(valid, top_bandgaps[best], np.nan)
+    best_jsc = np.where(valid, matched[best, np.arange(len(bottom_bandgaps))], np.nan)
+    return matched, best_top, best_jsc
+
+def mismatch_factor(wavelength, spectra, eqe, reference_spectrum, reference_eqe=None):
+    """
+    Calculate the spectral mismatch factor of each spectrum for each cell, relative to a reference spectrum.
+    M = (Jcell(spectrum) / Jcell(reference)) / (Jref(spectrum) / Jref(reference)), where Jref is the signal of the
+    reference device: a cell with `reference_eqe`, or a broadband (flat response) pyranometer if None.
+    Everything must be on the common `wavelength` grid: `spectra` has one spectrum per row (e.g. a time series),
+    `eqe` one curve per row (as fractions). The spectral response is proportional to EQE * wavelength and all the
+    integrals come from two matrix products, so thousands of spectra take a fraction of a second.
+    Returns an array of shape (number of spectra, number of cells).
+    """
+    wavelength = np.asarray(wavelength, dtype=float)
+    weights = trapezoid_weights(wavelength)
+    responses = np.atleast_2d(eqe) * wavelength
+    if reference_eqe is None:
+        reference_response = np.ones_like(wavelength)
+    else:
+        reference_response = np.asarray(reference_eqe, dtype=float) * wavelength
+    # Weighting the spectra by the integration weights once lets each integral be a dot product
+    weighted = np.atleast_2d(spectra) * weights
+    weighted_reference = np.asarray(reference_spectrum, dtype=float) * weights
+    cell_ratio = (weighted @ responses.T) / (weighted_reference @ responses.T)
+    reference_ratio = (weighted @ reference_response) / (weighted_reference @ reference_response)
+    return cell_ratio / reference_ratio[:, np.newaxis]
+
+# Wavelength range (nm) of the average photon energy, upper limit of the blue band (nm), and the wavelength of the
+# c-Si bandgap (nm) below which light is "useful"
+APE_RANGE = (350, 1050)
+BLUE_LIMIT = 550
+USEFUL_LIMIT = 1107
+
+def _band_weights(wavelength, lo, hi):
+    """Trapezium rule weights for the part of the grid between lo and hi (nm), zero outside it."""
+    return trapezoid_weights(np.clip(wavelength, lo, hi))
+
+def spectral_indices(wavelength, spectra, ape_range=APE_RANGE, blue_limit=BLUE_LIMIT, useful_limit=USEFUL_LIMIT):
+    """
+    Classify many spectra at once by their average photon energy (APE, eV), blue fraction and useful fraction.
+    APE is the irradiance divided by the photon flux (times the electron charge) over `ape_range`, the blue
+    fraction is the share of that irradiance below `blue_limit`, and the useful fraction the share of the whole
+    spectrum's irradiance below `useful_limit`.
+    `spectra` has one spectrum per row on the shared `wavelength` grid (a DataFrame keeps its index). Every
+    integral is a column of one weight matrix, so all the indices come from a single matrix product.
+    Returns a DataFrame with columns "ape", "blue_fraction" and "useful_fraction".
+    """
+    wavelength = np.asarray(wavelength, dtype=float)
+    index = spectra.index if isinstance(spectra, pd.DataFrame) else None
+    in_range = _band_weights(wavelength, *ape_range)
+    weights = np.column_stack([in_range,
+                               photon_flux(wavelength, in_range) * CHARGE,
+                               _band_weights(wavelength, ape_range[0], blue_limit),
+                               _band_weights(wavelength, wavelength[0], useful_limit),
+                               trapezoid_weights(wavelength)])
+    energy, photons, blue, useful, total = (np.atleast_2d(np.asarray(spectra, dtype=float)) @ weights).T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pd.DataFrame({"ape": energy / photons, "blue_fraction": blue / energy, "useful_fraction": useful / total},
+                            index=index)
+
+def iter_spectral_archive(filename, chunksize=10000):
+    """
+    Read a spectroradiometer archive CSV a block of `chunksize` spectra at a time.
+    The file has one spectrum per row: a timestamp (or other label) in the first column and then one column per
+    wavelength, with the wavelengths (nm) as the header. Yields (wavelength, block) with the block as a DataFrame.
+    """
+    for block in pd.read_csv(filename, index_col=0, chunksize=chunksize):
+        yield block.columns.to_numpy(dtype=float), block
+
+def spectral_indices_stream(blocks, **kwargs):
+    """
+    Calculate spectral_indices block by block from an iterable of (wavelength, spectra) pairs, e.g. from
+    iter_spectral_archive, so only one block is ever held in memory. Keyword arguments are passed on to
+    spectral_indices. Returns the indices of every spectrum in one DataFrame.
+    """
+    return pd.concat([spectral_indices(wavelength, spectra, **kwargs) for wavelength, spectra in blocks])
+
+LUT_CACHE_DIR = os.path.join("cache", "spectral_lut")
+# Default grids of the lookup table: relative airmass, precipitable water (cm) and aerosol optical depth at 500 nm
+LUT_AIRMASS = np.array([1, 1.25, 1.5, 1.75, 2, 2.5, 3, 4, 5, 6, 8, 10])
+LUT_PRECIPITABLE_WATER = np.array([0.25, 0.5, 1, 1.5, 2, 3, 4, 5])
+LUT_AEROSOL = np.array([0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5])
+# Spectrum the spectral factor is relative to, unless another one is given
+LUT_REFERENCE_FILE = 'AM15_G_raw.csv'
+
+def _lut_key(*arrays):
+    """Hash the inputs of a table (arrays or numbers), so a cached table is only re-used for exactly the same inputs."""
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+def build_spectral_lut(eqe_wavelength, eqe, airmass=LUT_AIRMASS, precipitable_water=LUT_PRECIPITABLE_WATER,
+                       aerosol=LUT_AEROSOL, reference=None, ozone=0.31, ground_albedo=0.2, surface_pressure=101325,
+                       dayofyear=81, cache_dir=LUT_CACHE_DIR):
+    """
+    Tabulate the spectral factor of a cell over a grid of airmass, precipitable water (cm) and aerosol optical
+    depth (500 nm), using the SPECTRL2 clear sky spectrum (on the horizontal) for every grid point.
+    The spectral factor is (Jsc / irradiance) under the modelled spectrum divided by the same under the reference
+    spectrum, i.e. the effective irradiance ratio a broadband (pyranometer) measurement must be multiplied by.
+    `eqe` is a fraction on `eqe_wavelength` and `reference` a (wavelength, irradiance) pair (AM1.5 from
+    LUT_REFERENCE_FILE if None). The other SPECTRL2 inputs (ozone in atm-cm, albedo, pressure in Pa, day of year)
+    are held fixed. The table is saved in `cache_dir` under a hash of all these inputs, and loaded from there when
+    nothing has changed (use cache_dir=None to always rebuild).
+    Returns a dict with the grids and the table ("factor", shape airmass x water x aerosol).
+    """
+    grids = (np.asarray(airmass, dtype=float), np.asarray(precipitable_water, dtype=float), np.asarray(aerosol, dtype=float))
+    reference_wl, reference_irr = load_spectrum(LUT_REFERENCE_FILE) if reference is None else reference
+    cache_file = None
+    if cache_dir is not None:
+        key = _lut_key(eqe_wavelength, eqe, *grids, reference_wl, reference_irr, ozone, ground_albedo,
+                       surface_pressure, dayofyear)
+        cache_file = os.path.join(cache_dir, key + ".npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as npz:
+                return {name: npz[name] for name in npz.files}
+    am, water, aod = (grid.ravel() for grid in np.meshgrid(*grids, indexing="ij"))
+    # SPECTRL2 also needs the zenith angle, taken from the airmass of a plane parallel atmosphere
+    zenith = np.degrees(np.arccos(1 / am))
+    spectra = pvlib.spectrum.spectrl2(apparent_zenith=zenith, aoi=zenith, surface_tilt=0, ground_albedo=ground_albedo,
+                                      surface_pressure=surface_pressure, relative_airmass=am, precipitable_water=water,
+                                      ozone=ozone, aerosol_turbidity_500nm=aod, dayofyear=dayofyear)
+    # One modelled spectrum per row, all integrated at once on their native grids
+    wavelength = spectra["wavelength"]
+    irradiance = np.asarray(spectra["poa_global"]).T
+    response = jsc_native(wavelength, irradiance, eqe_wavelength, eqe) / total_irradiance(wavelength, irradiance)
+    reference_response = (jsc_native(reference_wl, reference_irr, eqe_wavelength, eqe)
+                          / total_irradiance(reference_wl, reference_irr))
+    lut = {"airmass": grids[0], "precipitable_water": grids[1], "aerosol": grids[2],
+           "factor": (response / reference_response).reshape(len(grids[0]), len(grids[1]), len(grids[2]))}
+    if cache_file is not None:
+        cache_utils.save_npz(cache_file, **lut)
+    return lut
+
+def spectral_factor(lut, airmass, precipitable_water, aerosol):
+    """
+    Interpolate the spectral factor from a table made by build_spectral_lut (trilinear), for any number of
+    timestamps at once. Values outside the grids are held at the nearest edge.
+    """
+    grids = (lut["airmass"], lut["precipitable_water"], lut["aerosol"])
+    points = np.stack(np.broadcast_arrays(*(np.clip(np.asarray(v, dtype=float), g[0], g[-1])
+                                            for v, g in zip((airmass, precipitable_water, aerosol), grids))), axis=-1)
+    return RegularGridInterpolator(grids, lut["factor"])(points)
+
+def _is_eqe_file(filename):
+    """Check the header of a CSV for an EQE column, so spectra and other data in the same directory are skipped."""
+    with open(filename) as fid:
+        return "EQE" in fid.readline()
+
+def batch_jsc_report(eqe_dir, references, output_file="jsc_report.csv", pattern="*.csv", processes=None):
+    """
+    Calculate the Jsc (mA/cm^2) of every EQE file in `eqe_dir` under each of the reference spectra and write
+    one results table (CSV) with a row per EQE file and a column per reference.
+    EQE files are the CSVs matching `pattern` with "EQE" in the header ("wavelength / nm, EQE / %"). They are
+    parsed in a pool of `processes` worker processes (default one per CPU). Curves on the same wavelength grid
+    are then stacked and scored against each reference ({name: spectrum file}) in one call to jsc_native.
+    Returns the table as a DataFrame.
+    """
+    files = sorted(f for f in glob.glob(os.path.join(eqe_dir, pattern)) if _is_eqe_file(f))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Hand the files out in batches, as each one is quick to parse
+        curves = list(pool.map(load_spectrum, files, chunksize=max(1, len(files) // (4 * (processes or os.cpu_count() or 1)))))
+    spectra = {name: load_spectrum(filename) for name, filename in references.items()}
+    report = pd.DataFrame(index=pd.Index([os.path.basename(f) for f in files], name="file"),
+                          columns=[f"Jsc {name} (mA/cm^2)" for name in references], dtype=float)
+    groups = {}
+    for row, (eqe_wl, eqe) in enumerate(curves):
+        groups.setdefault(eqe_wl.tobytes(), []).append(row)
+    for rows in groups.values():
+        eqe_wl = curves[rows[0]][0]
+        eqe = np.vstack([curves[row][1] for row in rows]) / 100
+        for column, (wl, irr) in zip(report.columns, spectra.values()):
+            report.iloc[rows, report.columns.get_loc(column)] = jsc_native(wl, irr, eqe_wl, eqe)
+    report.to_csv(output_file)
+    return report
 
 def main():
-    AM15_spectrum = pd.read_csv('AM15_G_raw.csv', sep = ',' , header = 1)
-    eqe_spectrum = pd.read_csv('eqe_spectrum.csv', sep = ',' , header = 1)
-    
     start_wl = 300
     end_wl = 2000
-    step_wl = end_wl-start_wl
+    step_wl = 1
     
-    #following code interpolates the AM1.5 spectrum to 1nm spacing. for some reason i need to add another index "A". but i don't really know why!
-    AM15int = interpolate_wl_spectrum(start_wl=start_wl, end_wl=end_wl, step_wl=step_wl, input_spectrum = AM15_spectrum)
-    AM15int['A'] = list(range(len(AM15int.index)))
-    AM15int.plot.scatter(x=0, y=1)
+    #the AM1.5 spectrum, the cloudy spectrum and the EQE curves come from the spectral library (see spectral_library.py), already interpolated to step_wl spacing with a cubic spline. the library is built from the CSV files the first time (or when they change) and then read straight from disk. only start_wl to end_wl is used here.
+    library = spectral_library.load_library(step_wl=step_wl)
+    window = slice(*np.searchsorted(library["wavelength"], [start_wl, end_wl + step_wl / 2]))
+    grid = library["wavelength"][window]
+    AM15_common, cloudy_common = spectral_library.get_spectra(library, ["AM1.5", "Cloudy"])[:, window]
+    eqe_files = ['eqe_spectrum.csv', 'eqe_spectrum2.csv', 'eqe_spectrum3.csv']
+    eqe_common = spectral_library.get_spectra(library, ['eqe_spectrum', 'eqe_spectrum2', 'eqe_spectrum3'])[:, window]
+    plt.scatter(grid, AM15_common)
+    plt.show()
+    plt.scatter(grid, eqe_common[0])
+    plt.show()
+    
+    #convert AM1.5 to photon's per nm using a factor that is dependent on the wavelength x (see the notes!), multiply with the EQE spectrum (converted from % to a fraction) and integrate. see jsc above.
+    Jsc = jsc(grid, AM15_common, eqe_common[0] / 100)
+    print(f"Jsc = {Jsc:.2f} mA/cm^2")
+    #the same calculation can be done without interpolating at all, on the wavelengths in the files (see jsc_native).
+    AM15_wl, AM15_irr = load_spectrum('AM15_G_raw.csv')
+    eqe_wl, eqe = load_spectrum('eqe_spectrum.csv')
+    print(f"Jsc (native grids) = {jsc_native(AM15_wl, AM15_irr, eqe_wl, eqe / 100):.2f} mA/cm^2")
+    print(f"AM1.5 total irradiance = {total_irradiance(AM15_wl, AM15_irr):.1f} W/m^2")
+    
+    #the best possible Jsc of a cell with bandgap Eg collects every photon with energy above Eg. jsc_vs_bandgap works this out for a whole range of bandgaps at once, here for AM1.5 and the cloudy spectrum.
+    bandgaps = np.linspace(0.5, 3.0, 2501)
+    cloudy_wl, cloudy_irr = load_spectrum('G_spectrum.csv')
+    plt.plot(bandgaps, jsc_vs_bandgap(AM15_wl, AM15_irr, bandgaps), label="AM1.5")
+    plt.plot(bandgaps, jsc_vs_bandgap(cloudy_wl, cloudy_irr, bandgaps), label="Cloudy")
+    plt.xlabel("Bandgap (eV)")
+    plt.ylabel("Jsc (mA/cm^2)")
+    plt.legend()
     plt.show()
     
-    #following code interpolates EQE spectrum - exactly as with AM1.5
-    EQEint = interpolate_wl_spectrum(start_wl=start_wl, end_wl=end_wl, step_wl=step_wl, input_spectrum = eqe_spectrum)
-    EQEint['A'] = list(range(len(EQEint)))
-    EQEint.plot.scatter(x=0, y=1)
+    #for a two junction (tandem) cell the two currents must match. the contours show the matched current for each pair of bandgaps and the lines the best top bandgap for each bottom one, for AM1.5 (solid) and the cloudy spectrum (dashed). the current on its own is always highest for the smallest bottom bandgap, so the best top cell is printed for a silicon (1.12 eV) bottom cell instead.
+    top_bandgaps = np.linspace(1.0, 2.5, 601)
+    bottom_bandgaps = np.linspace(0.5, 1.5, 401)
+    silicon = np.argmin(np.abs(bottom_bandgaps - 1.12))
+    fig, ax = plt.subplots()
+    for (wl, irr, name, style) in [(AM15_wl, AM15_irr, "AM1.5", "-"), (cloudy_wl, cloudy_irr, "Cloudy", "--")]:
+        matched, best_top, best_jsc = tandem_current_matching(wl, irr, top_bandgaps, bottom_bandgaps)
+        print(f"{name}: best top cell on silicon {best_top[silicon]:.3f} eV, Jsc = {best_jsc[silicon]:.2f} mA/cm^2")
+        ax.contour(bottom_bandgaps, top_bandgaps, matched, levels=10, linestyles=style)
+        ax.plot(bottom_bandgaps, best_top, "k" + style, label=name)
+    ax.set_xlabel("Bottom bandgap (eV)")
+    ax.set_ylabel("Top bandgap (eV)")
+    ax.legend()
     plt.show()
     
-    #it'd be easy enough to now convert AM1.5 to photon's per nm using a factor that is dependent on the wavelength x (see the notes!) and then multiply with the EQE spectrum and then integrate the dataframe using a sum function.
+    #spectral mismatch of the three cells under the cloudy spectrum, relative to AM1.5 and measured with a pyranometer. to correct a whole time series of spectra pass them as the rows of one array.
+    mismatch = mismatch_factor(grid, cloudy_common, eqe_common / 100, AM15_common)
+    for f, m in zip(eqe_files, mismatch[0]):
+        print(f"{f}: mismatch factor under the cloudy spectrum = {m:.3f}")
+    
+    #average photon energy, blue fraction and useful fraction of both spectra. for an archive too big to load use spectral_indices_stream(iter_spectral_archive(filename)).
+    print(spectral_indices(grid, np.vstack([AM15_common, cloudy_common])).set_axis(["AM1.5", "Cloudy"]).round(3))
+    
+    #full spectral modelling at every timestamp is slow, so the spectral factor of a cell is tabulated once against airmass, water vapour and aerosols (and saved for next time), then looked up for every timestamp.
+    lut = build_spectral_lut(eqe_wl, eqe / 100)
+    airmass = np.linspace(1, 10, 200)
+    for water in (0.5, 1.5, 4):
+        plt.plot(airmass, spectral_factor(lut, airmass, water, 0.1), label=f"{water} cm water")
+    plt.xlabel("Airmass")
+    plt.ylabel("Spectral factor")
+    plt.legend()
+    plt.show()
     
     
 if __name__ == "__main__" :
-    main()
\ No newline at end of file
+    #### CONFIG / INPUTS #####
+    # Set to True to write a Jsc report for every EQE file in eqe_dir instead of running the walkthrough in main
+    batch = False
+    eqe_dir = "."
+    references = {"AM1.5": "AM15_G_raw.csv", "Cloudy": "G_spectrum.csv"}
+    ##########################
+    if batch:
+        print(batch_jsc_report(eqe_dir, references).round(2))
+    else:
+        main()
\ No newline at end of file